@@ -0,0 +1,140 @@
+# %%
+import os
+import time
+import hashlib
+from pathlib import Path
+import pandas as pd
+from siuba import collect
+from siuba.siu.dispatchers import verb_dispatch
+from siuba.sql import LazyTbl
+from utils import get_query_string
+
+
+# %%
+CACHE_DIR = Path(
+    os.getenv("BIZCATE_CACHE_DIR", Path.home() / ".cache" / "bizcate_model" / "collect")
+)
+CACHE_TTL = float(os.getenv("BIZCATE_CACHE_TTL", 12 * 60 * 60))  # seconds
+CACHE_MAX_BYTES = int(os.getenv("BIZCATE_CACHE_MAX_BYTES", 8 * 1024**3))
+
+# entries written before this time are expired, see invalidate_cache()
+_invalidated_at = 0.0
+
+
+# %%
+def cache_key(lazy_tbl):
+    """Hash of the compiled SQL, which already has literal binds rendered"""
+
+    query = get_query_string(lazy_tbl)
+    return hashlib.sha256(query.encode("utf-8")).hexdigest()
+
+
+def invalidate_cache(since=None):
+    """
+    Expire every entry written before since (now by default), in every thread.
+
+    Each query is then read from the warehouse once more and cached again, unlike
+    refresh=True, which refetches on every call.
+    """
+
+    global _invalidated_at
+    _invalidated_at = time.time() if since is None else since
+
+
+def expired(mtime, ttl=CACHE_TTL, now=None):
+    """True if a file written at mtime is older than ttl or was invalidated"""
+
+    now = time.time() if now is None else now
+    return mtime < _invalidated_at or (ttl is not None and now - mtime > ttl)
+
+
+def _cache_path(key, cache_dir):
+    return Path(cache_dir) / f"{key}.parquet"
+
+
+def _read_cached(path, ttl):
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+
+    # mtime is the write time, atime is (explicitly) bumped on every hit for LRU
+    now = time.time()
+    if expired(stat.st_mtime, ttl, now):
+        path.unlink(missing_ok=True)
+        return None
+
+    df = pd.read_parquet(path)
+    os.utime(path, (now, stat.st_mtime))
+    return df
+
+
+def _write_cached(df, path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # write to a temp file first so concurrent readers never see partial files
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    df.to_parquet(tmp_path, compression="zstd", index=False)
+    # same clock as invalidate_cache, the file system's can lag behind it
+    now = time.time()
+    os.utime(tmp_path, (now, now))
+    os.replace(tmp_path, path)
+
+
+def evict_cache(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+    """Drop expired entries, then least recently used ones until under max_bytes"""
+
+    now = time.time()
+    entries = []
+    for path in Path(cache_dir).glob("*.parquet"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+
+        if expired(stat.st_mtime, ttl, now):
+            path.unlink(missing_ok=True)
+        else:
+            entries.append((stat.st_atime, stat.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total_bytes -= size
+
+
+def clear_cache(cache_dir=CACHE_DIR):
+    for path in Path(cache_dir).glob("*.parquet"):
+        path.unlink(missing_ok=True)
+
+
+# %%
+@verb_dispatch(LazyTbl)
+def cached_collect(
+    __data,
+    ttl=CACHE_TTL,
+    cache_dir=CACHE_DIR,
+    max_bytes=CACHE_MAX_BYTES,
+    refresh=False,
+):
+    """Drop-in replacement for collect() that caches results on disk as Parquet"""
+
+    path = _cache_path(cache_key(__data), cache_dir)
+
+    if not refresh:
+        df = _read_cached(path, ttl)
+        if df is not None:
+            return df
+
+    df = __data >> collect()
+    _write_cached(df, path)
+    evict_cache(cache_dir, max_bytes=max_bytes, ttl=ttl)
+
+    return df
+
+
+@cached_collect.register(pd.DataFrame)
+def _cached_collect_df(__data, *args, **kwargs):
+    return __data
@@ -1,6 +1,7 @@
 # %%
 import os
 from db import fdb
+from cache import cached_collect
 from siuba import *
 from siuba.dply.vector import *
 import pyarrow as pa
@@ -97,7 +98,7 @@ def fetch_bizcate_mapping():
             _.BIZCATE_CODE.notna(),
         )
         >> distinct(_.BIZCATE_CODE, _.BIZCATE)
-        >> collect()
+        >> cached_collect()
     )
 
     return bizcate_mapping
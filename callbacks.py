@@ -1,60 +1,411 @@
+import os
+import json
+import time
+import hashlib
+import warnings
+from pathlib import Path
 from typing import Any, Dict
+import numpy as np
 from fusion_kf import Callback
-from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import PowerTransformer, StandardScaler
+from kf_engine import process_peak_rss_bytes
+
+
+SCALER_CACHE_DIR = Path(
+    os.getenv(
+        "BIZCATE_SCALER_CACHE_DIR", Path.home() / ".cache" / "bizcate_model" / "scaler"
+    )
+)
+
+
+def _flatten_fused(models):
+    # FusedKFModule holds one single-metric module per metric col
+    return [module for model in models for module in getattr(model, "modules", [model])]
+
+
+def _partition_key(partition):
+    # BatchedRunner puts the key in attrs, otherwise all rows share the id levels
+    if "partition_key" in partition.attrs:
+        return partition.attrs["partition_key"]
+    return tuple(partition.index[0][:-1])
+
+
+def _fit_standard(values):
+    # same as StandardScaler: NaNs are ignored, zero (or undefined) scale becomes 1
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mean = np.nanmean(values, axis=0)
+        scale = np.nanstd(values, axis=0)
+    mean[np.isnan(mean)] = 0.0
+    scale[np.isnan(scale) | (scale == 0)] = 1.0
+    return mean, scale
+
+
+def _yeo_johnson(x, lambdas):
+    # scipy.stats.yeojohnson for every column at once, lambdas broadcast over rows
+    eps = np.spacing(1.0)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        pos = np.where(
+            np.abs(lambdas) < eps,
+            np.log1p(np.abs(x)),
+            (np.power(np.abs(x) + 1, lambdas) - 1) / lambdas,
+        )
+        neg = np.where(
+            np.abs(lambdas - 2) > eps,
+            -(np.power(np.abs(x) + 1, 2 - lambdas) - 1) / (2 - lambdas),
+            -np.log1p(np.abs(x)),
+        )
+    return np.where(x >= 0, pos, np.where(np.isnan(x), np.nan, neg))
+
+
+def _inverse_yeo_johnson(x, lambdas):
+    eps = np.spacing(1.0)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        pos = np.where(
+            np.abs(lambdas) < eps,
+            np.exp(x) - 1,
+            np.power(x * lambdas + 1, 1 / lambdas) - 1,
+        )
+        neg = np.where(
+            np.abs(lambdas - 2) > eps,
+            1 - np.power(-(2 - lambdas) * x + 1, 1 / (2 - lambdas)),
+            1 - np.exp(-x),
+        )
+    return np.where(x >= 0, pos, np.where(np.isnan(x), np.nan, neg))
+
+
+def _fingerprints(cols, values):
+    # one digest per column of its label and raw values
+    return np.array(
+        [
+            hashlib.sha256(
+                repr(col).encode("utf-8") + np.ascontiguousarray(values[:, i]).tobytes()
+            ).hexdigest()
+            for i, col in enumerate(cols)
+        ]
+    )
 
 
 class Scaler(Callback):
     """
     Custom callback class that tarnsforms and inverse_transforms metric cols.
+
+    Each metric col x bizcate column is standardised per partition. The fitted
+    column keys, means and scales travel in partition.attrs when the runner carries
+    attrs from start to end (BatchedRunner does), so scaling works no matter which
+    process filters the partition. Otherwise they are kept in _fitted_scalers.
+    Either way they are dropped once the partition is inverse transformed.
+
+    Scaler(PowerTransformer, method="yeo-johnson") applies a Yeo-Johnson transform
+    with per-column lambdas before standardising, like sklearn's PowerTransformer.
+    With cache_dir set, fitted lambdas, means and scales are persisted per
+    partition and only columns whose values changed since the last run are refit.
+    The cache is keyed by name (e.g. the spec name), the metric cols and the
+    partition, so specs sharing a cache_dir keep their own params. Because it fits
+    on the data it sees, BatchedRunner refuses it for incremental runs.
     """
 
+    fits_on_data = True
+
     def __init__(
         self,
+        transformer=StandardScaler,
+        method="yeo-johnson",
+        cache_dir=None,
+        name=None,
     ):
-        self._fitted_scalers = dict()
+        if transformer is PowerTransformer and method != "yeo-johnson":
+            raise ValueError(f"unsupported PowerTransformer method {method!r}")
+        if transformer not in (StandardScaler, PowerTransformer):
+            raise ValueError(f"unsupported transformer {transformer!r}")
+
+        self.transformer = transformer
+        self.method = method
+        self.power = transformer is PowerTransformer
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.name = name
+        self._fitted_scalers: Dict[Any, tuple] = dict()
+
+    def _fit(self, values):
+        lambdas = np.ones(values.shape[1])
+        if self.power:
+            # lambdas only, standardising NaN-aware below like PowerTransformer does
+            # columns without data keep lambda 1 (identity), sklearn fails on them
+            fittable = (~np.isnan(values)).sum(axis=0) > 1
+            if fittable.any():
+                pt = PowerTransformer(method="yeo-johnson", standardize=False)
+                lambdas[fittable] = pt.fit(values[:, fittable]).lambdas_
+            values = _yeo_johnson(values, lambdas)
+        mean, scale = _fit_standard(values)
+        return lambdas, mean, scale
+
+    def _cache_path(self, partition_key, metric_cols):
+        key = hashlib.sha256(
+            repr(
+                (self.name, sorted(metric_cols), tuple(map(str, partition_key)))
+            ).encode("utf-8")
+        )
+        kind = "yeo_johnson" if self.power else "standard"
+        return self.cache_dir / kind / f"{key.hexdigest()}.npz"
+
+    def _fit_cached(self, partition_key, metric_cols, cols, values):
+        """Reuse persisted params for unchanged columns, refit and persist the rest"""
+
+        path = self._cache_path(partition_key, metric_cols)
+        fingerprints = _fingerprints(cols, values)
+        params = np.full((3, len(fingerprints)), np.nan)
+        stale = np.ones(len(fingerprints), dtype=bool)
+
+        try:
+            with np.load(path, allow_pickle=False) as cached:
+                positions = {fp: i for i, fp in enumerate(cached["fingerprints"])}
+                hits = np.array([positions.get(fp, -1) for fp in fingerprints])
+                stale = hits < 0
+                params[:, ~stale] = cached["params"][:, hits[~stale]]
+        except FileNotFoundError:
+            pass
+
+        if stale.any():
+            params[:, stale] = self._fit(values[:, stale])
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                np.savez(f, fingerprints=fingerprints, params=params)
+            os.replace(tmp_path, path)
+
+        return params
+
+    def _transform(self, values, lambdas, mean, scale):
+        if self.power:
+            values = _yeo_johnson(values, lambdas)
+        return (values - mean) / scale
+
+    def _inverse_transform(self, values, lambdas, mean, scale):
+        values = values * scale + mean
+        if self.power:
+            values = _inverse_yeo_johnson(values, lambdas)
+        return values
 
     def on_model_partition_start(self, models, partition):
-        levels_to_keep = partition.index.nlevels - 1
-        partition_key = list(
-            set([tuple(idx[:levels_to_keep]) for idx in partition.index])
-        )[0]
+        models = _flatten_fused(models)
 
         # transforms unique set of metric cols when multiple models are specified
-        cols_to_transform = list(set([model.metric_col for model in models]))
-
-        scalers = {}
-        # Iterate through the columns and scale each one individually
-        for metric_col in cols_to_transform:
-            for col in partition[[metric_col]].columns:
-                scaler = StandardScaler()
-                partition.loc[:, col] = scaler.fit_transform(partition[[col]])
-                scalers[col] = scaler
-        self._fitted_scalers[partition_key] = scalers
+        metric_cols = {model.metric_col for model in models}
+        positions = np.flatnonzero(
+            partition.columns.get_level_values(0).isin(metric_cols)
+        )
+
+        cols = partition.columns[positions]
+        values = partition.iloc[:, positions].to_numpy(dtype=np.float64)
+        if self.cache_dir is not None:
+            lambdas, mean, scale = self._fit_cached(
+                _partition_key(partition), metric_cols, cols, values
+            )
+        else:
+            lambdas, mean, scale = self._fit(values)
+        partition.iloc[:, positions] = self._transform(values, lambdas, mean, scale)
+
+        state = (cols, lambdas, mean, scale)
+        if "partition_key" in partition.attrs:
+            partition.attrs["scaler"] = state
+        else:
+            self._fitted_scalers[_partition_key(partition)] = state
         return partition
 
     def on_model_partition_end(self, models, partition):
-        levels_to_keep = partition.index.nlevels - 1
-        partition_key = list(
-            set([tuple(idx[:levels_to_keep]) for idx in partition.index])
-        )[0]
+        models = _flatten_fused(models)
+        state = partition.attrs.pop("scaler", None)
+        if state is None:
+            state = self._fitted_scalers.pop(_partition_key(partition))
+        fitted_cols, lambdas, mean, scale = state
+
+        # metric & output cols are inverse transformed with their metric col's scaler
+        source_cols = {}
+        for model in models:
+            for col in (model.metric_col, *model.output_cols):
+                source_cols.setdefault(col, model.metric_col)
 
-        scalers = self._fitted_scalers[partition_key]
+        cols = partition.columns
+        top_level = cols.get_level_values(0)
+        positions = np.flatnonzero(top_level.isin(list(source_cols)))
+        source_keys = [(source_cols[top_level[i]], *cols[i][1:]) for i in positions]
+        scaler_positions = fitted_cols.get_indexer(source_keys)
 
-        # transforms unique set of metric & output cols
-        # when multiple models are specified
-        col_sets_to_transform = list(
-            set([(model.metric_col, *model.output_cols) for model in models])
+        values = partition.iloc[:, positions].to_numpy(dtype=np.float64)
+        partition.iloc[:, positions] = self._inverse_transform(
+            values,
+            lambdas[scaler_positions],
+            mean[scaler_positions],
+            scale[scaler_positions],
         )
+        return partition
+
+
+def _json_key(partition_key):
+    # numpy scalars are not JSON serialisable
+    return [k.item() if isinstance(k, np.generic) else k for k in partition_key]
 
-        transformed = []
-        # Use the stored scalers for inverse_transform
-        for col_set in col_sets_to_transform:
-            for metric_col in col_set:
-                if metric_col not in transformed:
-                    for col in partition[[metric_col]].columns:
-                        scaler = scalers[(col_set[0], *col[1:])]
-                        partition.loc[:, col] = scaler.inverse_transform(partition[[col]])  # fmt: skip
 
-                    transformed.append(metric_col)
+class Instrumentation(Callback):
+    """
+    Custom callback class that records per partition rows, bizcates (B), months (T),
+    filter time and memory.
+
+    Only whole batches are timed, so batch_seconds_share and batch_cpu_seconds_share
+    are the batch's filter time split evenly over its batch_size partitions (with
+    other runners a batch of one, timed between the start and end hooks).
+    process_peak_rss_bytes is the lifetime high-water mark (ru_maxrss) of the
+    filtering process, not the peak of the partition. Each run appends its
+    records to json_path as JSON lines and rewrites prom_path as a Prometheus
+    textfile summarising every run so far. Progress is printed when verbose.
+
+    Partitions a checkpoint already holds are not filtered and get no records,
+    they are counted in skipped_partitions and left out of the progress total.
+    """
+
+    def __init__(
+        self, json_path=None, prom_path=None, run_name="bizcate_kf", verbose=True
+    ):
+        self.json_path = Path(json_path) if json_path is not None else None
+        self.prom_path = Path(prom_path) if prom_path is not None else None
+        self.run_name = run_name
+        self.verbose = verbose
+
+        self.records = []
+        self.run_seconds = 0.0
+        self.total_partitions = None
+        self.skipped_partitions = 0
+        self._run_skipped = 0
+        self._run_records = []
+        self._run_start = None
+        self._starts: Dict[Any, tuple] = dict()
+        self._last_progress = -1
+
+    def on_run_start(self, models, dataloaders):
+        self.total_partitions = sum(
+            dl.table.groupby(list(dl.id_cols)).ngroups for dl in dataloaders
+        )
+        self._run_records = []
+        self._run_skipped = 0
+        self._run_start = time.perf_counter()
+        self._last_progress = -1
+
+    def on_partitions_skipped(self, models, partition_keys):
+        self._run_skipped += len(partition_keys)
+        self.skipped_partitions += len(partition_keys)
+
+    def on_model_partition_start(self, models, partition):
+        self._starts[_partition_key(partition)] = (
+            time.perf_counter(),
+            time.process_time(),
+        )
+        return partition
+
+    def on_model_partition_end(self, models, partition):
+        partition_key = _partition_key(partition)
+        wall_start, cpu_start = self._starts.pop(partition_key, (None, None))
+        attrs = partition.attrs
+
+        if "batch_seconds_share" in attrs:
+            wall_seconds = attrs["batch_seconds_share"]
+            cpu_seconds = attrs["batch_cpu_seconds_share"]
+        else:
+            # a batch of one, timed between its own hooks
+            wall_seconds = time.perf_counter() - wall_start
+            cpu_seconds = time.process_time() - cpu_start
+
+        peaks = [attrs.get("process_peak_rss_bytes"), process_peak_rss_bytes()]
+        peaks = [peak for peak in peaks if peak is not None]
+
+        record = {
+            "run_name": self.run_name,
+            "partition_key": _json_key(partition_key),
+            "rows": len(partition),
+            "bizcates": partition.columns.droplevel(0).nunique(),
+            "months": partition.index.get_level_values(-1).nunique(),
+            "batch_size": attrs.get("batch_size", 1),
+            "batch_seconds_share": wall_seconds,
+            "batch_cpu_seconds_share": cpu_seconds,
+            "process_peak_rss_bytes": max(peaks) if peaks else None,
+        }
+        self._run_records.append(record)
+        self.records.append(record)
+
+        to_filter = (self.total_partitions or 0) - self._run_skipped
+        if self.verbose and to_filter > 0:
+            progress = int(100 * len(self._run_records) / to_filter)
+            if progress > self._last_progress:
+                print(f"Progress: {progress}%")
+                self._last_progress = progress
 
         return partition
+
+    def on_run_end(self, models, output):
+        if self._run_start is not None:
+            self.run_seconds += time.perf_counter() - self._run_start
+            self._run_start = None
+
+        if self.json_path is not None:
+            self.json_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.json_path, "a") as f:
+                for record in self._run_records:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+        if self.prom_path is not None:
+            self.write_prometheus(self.prom_path)
+
+    def metrics(self):
+        """Summary of all recorded runs as {metric name: (help, value)}"""
+
+        records = self.records
+        seconds = [r["batch_seconds_share"] for r in records]
+        cpu_seconds = [r["batch_cpu_seconds_share"] for r in records]
+        peaks = [
+            r["process_peak_rss_bytes"]
+            for r in records
+            if r["process_peak_rss_bytes"] is not None
+        ]
+        return {
+            "bizcate_kf_run_seconds": ("Wall time of the runs", self.run_seconds),
+            "bizcate_kf_partitions": ("Partitions filtered", len(records)),
+            "bizcate_kf_partitions_skipped": (
+                "Partitions a checkpoint already held",
+                self.skipped_partitions,
+            ),
+            "bizcate_kf_rows": (
+                "Wide partition rows filtered",
+                sum(r["rows"] for r in records),
+            ),
+            "bizcate_kf_filter_seconds_total": (
+                "Filter wall time summed over batches",
+                sum(seconds),
+            ),
+            "bizcate_kf_filter_cpu_seconds_total": (
+                "Filter CPU time summed over batches",
+                sum(cpu_seconds),
+            ),
+            "bizcate_kf_batch_seconds_share_max": (
+                "Largest per-partition share of a batch's filter wall time",
+                max(seconds, default=0.0),
+            ),
+            "bizcate_kf_process_peak_rss_bytes": (
+                "Lifetime peak resident memory of the filtering processes",
+                max(peaks, default=0),
+            ),
+        }
+
+    def write_prometheus(self, path):
+        lines = []
+        for name, (help_text, value) in self.metrics().items():
+            lines += [
+                f"# HELP {name} {help_text}",
+                f"# TYPE {name} gauge",
+                f'{name}{{run_name="{self.run_name}"}} {value}',
+            ]
+
+        # textfile collectors may read at any time, so replace the file atomically
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
@@ -1,21 +1,123 @@
 # %%
 import os
-from dotenv import load_dotenv
-from fusion_db import FusionDB
+import functools
+import threading
+import numpy as np
+import pandas as pd
 from siuba import *
 
+
+# %%
+class LazyProxy:
+    """
+    Stands in for the object factory() returns, which is only built on first use.
+
+    Attribute access, indexing, calls and >> are forwarded, so importing a module
+    that holds a LazyProxy costs nothing. isinstance checks are not: they see the
+    proxy and never connect.
+    """
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_target", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _resolve(self):
+        target = object.__getattribute__(self, "_target")
+        if target is None:
+            with object.__getattribute__(self, "_lock"):
+                target = object.__getattribute__(self, "_target")
+                if target is None:
+                    target = object.__getattribute__(self, "_factory")()
+                    object.__setattr__(self, "_target", target)
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __rshift__(self, other):
+        return self._resolve() >> other
+
+    def __repr__(self):
+        return repr(self._resolve())
+
+
 # %%
-load_dotenv()
-DB_USER = os.getenv("db_username")
-DB_PASSWORD = os.getenv("db_password")
+@functools.lru_cache(maxsize=None)
+def connect(user=None, password=None, role=None):
+    """
+    FusionDB connection for the given credentials (from .env by default).
+
+    Cached, so every script and helper run in the same process shares one
+    connection and its connection pool.
+    """
+
+    from dotenv import load_dotenv
+    from fusion_db import FusionDB
+
+    load_dotenv()
+    return FusionDB(
+        user=user or os.getenv("db_username"),
+        password=password or os.getenv("db_password"),
+        role=role,
+    )
+
 
 # %%
-fdb = FusionDB(user=DB_USER, password=DB_PASSWORD, role=None)
+fdb = LazyProxy(connect)
 
 # %%
 # fmt: off
-month_mapping = (
-    fdb.LOOKUP.ZZINFO.F005_MONTH(lazy=True) 
+month_mapping = LazyProxy(
+    lambda: fdb.LOOKUP.ZZINFO.F005_MONTH(lazy=True)
     >> select("MONTH_NUM", "MONTH_YEAR")
 )
 # fmt: on
+
+
+# %%
+@functools.lru_cache(maxsize=None)
+def month_lookup():
+    """
+    MONTH_YEAR of every MONTH_NUM as datetime.date, like collect() returns the DATE
+    column, in an object array indexed by MONTH_NUM (NaT for gaps).
+
+    The mapping is read once per process (and cached on disk by cached_collect),
+    so warehouse queries keep the integer MONTH_NUM instead of joining F005_MONTH.
+    """
+
+    from cache import cached_collect
+
+    mapping = month_mapping >> cached_collect()
+    month_nums = mapping["MONTH_NUM"].to_numpy(dtype=np.int64)
+
+    # dates stay DATE when uploaded, datetime64 would become TIMESTAMP
+    lookup = np.full(month_nums.max() + 1, pd.NaT, dtype=object)
+    lookup[month_nums] = pd.to_datetime(mapping["MONTH_YEAR"]).dt.date.to_numpy()
+    return lookup
+
+
+def with_month_year(df, month_col="MONTH_NUM", date_col="MONTH_YEAR"):
+    """
+    df with month_col replaced by date_col in place, looked up in month_lookup.
+
+    Months missing from the mapping (gaps, beyond the last one, NaN) get NaT, like
+    the left join on F005_MONTH did.
+    """
+
+    lookup = month_lookup()
+    month_nums = df[month_col].to_numpy(dtype=float, na_value=np.nan)
+    known = (month_nums >= 0) & (month_nums < len(lookup))
+
+    month_years = np.full(len(df), pd.NaT, dtype=object)
+    month_years[known] = lookup[month_nums[known].astype(np.int64)]
+    position = df.columns.get_loc(month_col)
+    df = df.drop(columns=month_col)
+    df.insert(position, date_col, month_years)
+    return df
@@ -0,0 +1,1112 @@
+# %%
+import os
+import sys
+import json
+import time
+import uuid
+import hashlib
+import inspect
+from pathlib import Path
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# %%
+# Random walk (local level) model used by all bizcate KF modules:
+#   x_t = x_{t-1} + w_t,  w_t ~ N(0, Q)
+#   z_t = x_t + v_t,      v_t ~ N(0, R_t)
+# The first month initialises the state from its own measurement (diffuse prior).
+
+
+def is_diagonal(m):
+    """True if every off-diagonal entry of the trailing (B, B) matrices is zero"""
+
+    return not np.any(m[..., ~np.eye(m.shape[-1], dtype=bool)])
+
+
+def _update_diagonal_r(x, P, z, r):
+    # S = P + diag(r), built in place instead of materialising diag(r)
+    S = P.copy()
+    diag = np.einsum("...ii->...i", S)
+    diag += r
+    # K = P S^-1 = (S^-1 P)^T since P and S are symmetric
+    K = np.swapaxes(np.linalg.solve(S, P), -1, -2)
+    x = x + np.einsum("...ij,...j->...i", K, z - x)
+    P = P - K @ P
+    return x, (P + np.swapaxes(P, -1, -2)) / 2
+
+
+def _update_dense_r(x, P, z, R):
+    S = P + R
+    K = np.swapaxes(np.linalg.solve(S, P), -1, -2)
+    x = x + np.einsum("...ij,...j->...i", K, z - x)
+    P = P - K @ P
+    return x, (P + np.swapaxes(P, -1, -2)) / 2
+
+
+def kalman_filter(zs, Q, Rs, x0=None, P0=None):
+    """
+    Forward pass over the month axis.
+
+    zs: (..., T, B) measurements, NaN treated as uninformative
+    Q: (B, B) process covariance
+    Rs: (..., T, B) measurement variances (diagonal mode) or (..., T, B, B)
+    x0, P0: optional posterior (..., B) and (..., B[, B]) of the month before zs,
+        used instead of the diffuse prior to resume a previous run
+
+    Returns filtered means (..., T, B) and covariances, which are (..., T, B) when
+    both Q and Rs are diagonal and (..., T, B, B) otherwise.
+    """
+
+    zs = np.nan_to_num(zs, nan=0.0)
+    if Rs.ndim > zs.ndim and is_diagonal(Rs):
+        Rs = np.diagonal(Rs, axis1=-2, axis2=-1)
+    diagonal_r = Rs.ndim == zs.ndim
+    elementwise = diagonal_r and is_diagonal(Q)
+
+    if P0 is not None:
+        dense_p0 = P0.ndim > x0.ndim
+        if elementwise and dense_p0:
+            if is_diagonal(P0):
+                P0 = np.diagonal(P0, axis1=-2, axis2=-1)
+            else:
+                elementwise = False
+        elif not elementwise and not dense_p0:
+            P0 = P0[..., np.newaxis] * np.eye(P0.shape[-1])
+
+    if elementwise:
+        return _kalman_filter_elementwise(zs, np.diagonal(Q), Rs, x0, P0)
+
+    T = zs.shape[-2]
+    xs = np.empty(zs.shape)
+    Ps = np.empty(zs.shape + zs.shape[-1:])
+
+    if x0 is None:
+        # diffuse prior: the first update returns the first measurement and its noise
+        xs[..., 0, :] = zs[..., 0, :]
+        if diagonal_r:
+            Ps[..., 0, :, :] = 0
+            np.einsum("...ii->...i", Ps[..., 0, :, :])[...] = Rs[..., 0, :]
+        else:
+            Ps[..., 0, :, :] = Rs[..., 0, :, :]
+        start = 1
+    else:
+        start = 0
+
+    for t in range(start, T):
+        x_prev, P_prev = (xs[..., t - 1, :], Ps[..., t - 1, :, :]) if t else (x0, P0)
+        x_pred, P_pred = x_prev, P_prev + Q
+        if diagonal_r:
+            x, P = _update_diagonal_r(x_pred, P_pred, zs[..., t, :], Rs[..., t, :])
+        else:
+            x, P = _update_dense_r(x_pred, P_pred, zs[..., t, :], Rs[..., t, :, :])
+        xs[..., t, :], Ps[..., t, :, :] = x, P
+
+    return xs, Ps
+
+
+def _kalman_filter_elementwise(zs, q, rs, x0=None, p0=None):
+    # with diagonal Q and R every bizcate is an independent scalar filter
+    T = zs.shape[-2]
+    xs = np.empty(zs.shape)
+    Ps = np.empty(zs.shape)
+
+    if x0 is None:
+        xs[..., 0, :] = zs[..., 0, :]
+        Ps[..., 0, :] = rs[..., 0, :]
+        start = 1
+    else:
+        start = 0
+
+    for t in range(start, T):
+        x_prev, P_prev = (xs[..., t - 1, :], Ps[..., t - 1, :]) if t else (x0, p0)
+        P_pred = P_prev + q
+        K = P_pred / (P_pred + rs[..., t, :])
+        xs[..., t, :] = x_prev + K * (zs[..., t, :] - x_prev)
+        Ps[..., t, :] = (1 - K) * P_pred
+
+    return xs, Ps
+
+
+def rts_smoother(xs, Ps, Q, return_cov=False):
+    """
+    Rauch-Tung-Striebel backward pass over the output of kalman_filter.
+
+    Predicted covariances are recomputed as P_t + Q rather than stored. Returns the
+    smoothed means, and with return_cov=True (means, covariances); the smoothed
+    covariances cost a copy of Ps and two B x B products per month, so they are
+    skipped unless asked for.
+    """
+
+    if Ps.ndim == xs.ndim:
+        return _rts_smoother_elementwise(xs, Ps, np.diagonal(Q), return_cov)
+
+    T = xs.shape[-2]
+    xs_s = xs.copy()
+    Ps_s = Ps.copy() if return_cov else None
+
+    for t in range(T - 2, -1, -1):
+        P_pred = Ps[..., t, :, :] + Q
+        # C = P_t P_pred^-1 = (P_pred^-1 P_t)^T
+        C = np.swapaxes(np.linalg.solve(P_pred, Ps[..., t, :, :]), -1, -2)
+        xs_s[..., t, :] += np.einsum(
+            "...ij,...j->...i", C, xs_s[..., t + 1, :] - xs[..., t, :]
+        )
+        if return_cov:
+            Ps_s[..., t, :, :] += (
+                C @ (Ps_s[..., t + 1, :, :] - P_pred) @ np.swapaxes(C, -1, -2)
+            )
+
+    return (xs_s, Ps_s) if return_cov else xs_s
+
+
+def _rts_smoother_elementwise(xs, Ps, q, return_cov=False):
+    T = xs.shape[-2]
+    xs_s = xs.copy()
+    Ps_s = Ps.copy() if return_cov else None
+
+    for t in range(T - 2, -1, -1):
+        P_pred = Ps[..., t, :] + q
+        C = Ps[..., t, :] / P_pred
+        xs_s[..., t, :] += C * (xs_s[..., t + 1, :] - xs[..., t, :])
+        if return_cov:
+            Ps_s[..., t, :] += C**2 * (Ps_s[..., t + 1, :] - P_pred)
+
+    return (xs_s, Ps_s) if return_cov else xs_s
+
+
+def fixed_lag_smoother(xs, Ps, Q, lag):
+    """
+    Smoothed means of every month given at most lag later months, x_{t|t+lag}.
+
+    A month's value is frozen once lag more months have arrived, so refreshes only
+    move the last lag months. RTS restricted to months t..t+lag gives x_{t|t+lag}
+    exactly, all months are stepped back together lag times.
+    """
+
+    T = xs.shape[-2]
+    if lag is None or lag >= T - 1:
+        return rts_smoother(xs, Ps, Q)
+    elementwise = Ps.ndim == xs.ndim
+
+    # smoother gains C_t for t < T - 1, shared by every month's window
+    if elementwise:
+        C = Ps[..., :-1, :] / (Ps[..., :-1, :] + np.diagonal(Q))
+    else:
+        P_pred = Ps[..., :-1, :, :] + Q
+        C = np.swapaxes(np.linalg.solve(P_pred, Ps[..., :-1, :, :]), -1, -2)
+
+    # month t starts at the end of its window, min(t + lag, T - 1), and steps back
+    ends = np.minimum(np.arange(T) + lag, T - 1)
+    smoothed = xs[..., ends, :].copy()
+    for k in range(lag - 1, -1, -1):
+        t = np.arange(T - 1 - k)  # months whose window still includes t + k + 1
+        j = t + k
+        innovation = smoothed[..., t, :] - xs[..., j, :]
+        if elementwise:
+            smoothed[..., t, :] = xs[..., j, :] + C[..., j, :] * innovation
+        else:
+            smoothed[..., t, :] = xs[..., j, :] + np.einsum(
+                "...ij,...j->...i", C[..., j, :, :], innovation
+            )
+
+    return smoothed
+
+
+# %%
+OUTPUTS = ("KF", "RTS")
+
+
+def output_col_prefix(model):
+    return getattr(model, "output_col_prefix", None) or model.metric_col
+
+
+def _as_covariance(P, xs, dense):
+    # convert stored covariances between the elementwise and the dense code path
+    if dense and P.ndim == xs.ndim:
+        return P[..., np.newaxis] * np.eye(P.shape[-1])
+    if not dense and P.ndim > xs.ndim:
+        return np.diagonal(P, axis1=-2, axis2=-1)
+    return P
+
+
+def filter_batch(
+    model,
+    batch,
+    n_partitions,
+    priors=None,
+    keep_last=0,
+    smoother_lag=None,
+    outputs=OUTPUTS,
+):
+    """
+    Run model over n_partitions stacked wide partitions sharing months and bizcates.
+
+    batch rows are partition-major then month, columns are col x bizcate. The
+    filter and smoother run once over (M, P, T, B) arrays, M being the number of
+    metrics of a FusedKFModule (1 otherwise), and Q is built once.
+
+    priors: optional {output_col_prefix: (xs, Ps)} filtered states of a previous
+        run for the first W months of batch, shaped (P, W, B) and (P, W, B[, B]).
+        Only the remaining months are filtered, the smoother reruns over all of them.
+    keep_last: number of trailing filtered states to return for persisting.
+    smoother_lag: if set, _RTS columns are fixed-lag smoothed (see fixed_lag_smoother)
+    outputs: which of the KF and RTS columns to return, the smoother is skipped
+        when RTS is not needed
+
+    Returns ({output_col: (P, T, B) array}, {output_col_prefix: (xs, Ps)}).
+    """
+
+    modules = getattr(model, "modules", [model])
+    zs = np.stack(
+        [
+            batch.loc[:, [module.metric_col]].to_numpy(dtype=np.float64)
+            for module in modules
+        ]
+    )
+    M, P, B = len(modules), n_partitions, zs.shape[-1]
+    T = len(batch) // P
+    zs = zs.reshape(M, P, T, B)
+
+    Q = np.asarray(model.process_covariance(batch), dtype=np.float64)
+    Rs = np.asarray(model.measurement_covariance(batch), dtype=np.float64)
+    if not hasattr(model, "modules"):
+        Rs = Rs[np.newaxis]
+    # (M, P * T, B[, B]) -> (M, P, T, B[, B])
+    Rs = Rs.reshape(M, P, T, *Rs.shape[2:])
+
+    prefixes = [output_col_prefix(module) for module in modules]
+    if priors is None:
+        xs, Ps = kalman_filter(zs, Q, Rs)
+    else:
+        xs_w = np.stack([priors[prefix][0] for prefix in prefixes])
+        Ps_w = np.stack([priors[prefix][1] for prefix in prefixes])
+        W = xs_w.shape[-2]
+        xs, Ps = kalman_filter(
+            zs[:, :, W:], Q, Rs[:, :, W:], x0=xs_w[:, :, -1], P0=Ps_w[:, :, -1]
+        )
+        Ps_w = _as_covariance(Ps_w, xs_w, dense=Ps.ndim > xs.ndim)
+        xs = np.concatenate([xs_w, xs], axis=2)
+        Ps = np.concatenate([Ps_w, Ps], axis=2)
+    values = {"KF": xs}
+    if "RTS" in outputs:
+        values["RTS"] = fixed_lag_smoother(xs, Ps, Q, smoother_lag)
+
+    output_values, states = {}, {}
+    for i, prefix in enumerate(prefixes):
+        for output in outputs:
+            output_values[f"{prefix}_{output}"] = values[output][i]
+        if keep_last:
+            states[prefix] = (xs[i, :, -keep_last:], Ps[i, :, -keep_last:])
+    return output_values, states
+
+
+def process_peak_rss_bytes():
+    """
+    Lifetime high-water mark of the current process's resident memory (ru_maxrss),
+    not the peak of any one partition or batch. None where unsupported.
+    """
+
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _filter_batch_all_models(models, batch, n_partitions, priors=None, **kwargs):
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    outputs, states = {}, {}
+    for model in models:
+        model_outputs, model_states = filter_batch(
+            model, batch, n_partitions, priors=priors, **kwargs
+        )
+        outputs.update(model_outputs)
+        states.update(model_states)
+
+    stats = {
+        "batch_seconds": time.perf_counter() - wall_start,
+        "batch_cpu_seconds": time.process_time() - cpu_start,
+        "process_peak_rss_bytes": process_peak_rss_bytes(),
+    }
+    return outputs, states, stats
+
+
+def _append_outputs(batch, outputs):
+    vars_index = batch.columns.droplevel(0).unique()
+    output_df = pd.concat(
+        [
+            pd.DataFrame(
+                values.reshape(len(batch), -1),
+                index=batch.index,
+                columns=pd.MultiIndex.from_product(
+                    [[col], vars_index], names=batch.columns.names
+                ),
+            )
+            for col, values in outputs.items()
+        ],
+        axis=1,
+    )
+    appended = pd.concat([batch, output_df], axis=1)
+    appended.attrs = batch.attrs
+    return appended
+
+
+def filter_partition(model, partition):
+    """
+    Run model over one wide partition (index: ids + date, columns: col x bizcate)
+    and append its <prefix>_KF and <prefix>_RTS columns.
+    """
+
+    outputs, _ = filter_batch(model, partition, 1)
+    return _append_outputs(partition, outputs)
+
+
+def _factorize(table, cols):
+    if table.empty:
+        # factorize can't infer the levels of an empty MultiIndex
+        uniques = (
+            pd.MultiIndex.from_frame(table[cols])
+            if len(cols) > 1
+            else pd.Index(table[cols[0]])
+        )
+        return np.empty(0, dtype=np.intp), uniques.set_names(cols)
+    keys = (
+        pd.MultiIndex.from_frame(table[cols])
+        if len(cols) > 1
+        else pd.Index(table[cols[0]])
+    )
+    codes, uniques = keys.factorize(sort=True)
+    return codes, uniques.set_names(cols)
+
+
+def _scatter(values, flat_positions, size):
+    # missing cells become NaN, like unstack (ints are upcast to float)
+    if len(flat_positions) == size:
+        out = np.empty(size, dtype=values.dtype)
+    elif values.dtype.kind in "iub":
+        out = np.full(size, np.nan)
+    elif values.dtype.kind in "fc":
+        out = np.full(size, np.nan, dtype=values.dtype)
+    else:
+        out = np.full(size, np.nan, dtype=object)
+    out[flat_positions] = values
+    return out
+
+
+class Panel:
+    """
+    Long table indexed into partitions (id_cols), months (date_col) and vars (var_cols).
+
+    Partitions that observe exactly the same months and vars are compatible and can
+    be gathered into one dense (P, T, B) batch without any per-partition pivoting.
+    """
+
+    def __init__(self, table, id_cols, date_col, var_cols):
+        self.id_cols = list(id_cols)
+        self.date_col = date_col
+        self.var_cols = list(var_cols)
+        keys = self.id_cols + [date_col] + self.var_cols
+        self.value_cols = [col for col in table.columns if col not in keys]
+
+        table = table.dropna(subset=keys)
+        self.table = table
+        self.partition_codes, self.partition_ids = _factorize(table, self.id_cols)
+        self.date_codes, self.dates = _factorize(table, [date_col])
+        self.var_codes, self.vars = _factorize(table, self.var_cols)
+
+        # rows sorted by partition, month, var; partition p is order[starts[p]:ends[p]]
+        self.order = np.lexsort((self.var_codes, self.date_codes, self.partition_codes))
+        bounds = np.searchsorted(
+            self.partition_codes[self.order], np.arange(len(self.partition_ids) + 1)
+        )
+        self.starts, self.ends = bounds[:-1], bounds[1:]
+
+    def __len__(self):
+        return len(self.partition_ids)
+
+    def partition_key(self, p):
+        key = self.partition_ids[p]
+        return key if isinstance(key, tuple) else (key,)
+
+    def signature(self, p):
+        rows = self.order[self.starts[p] : self.ends[p]]
+        return np.unique(self.date_codes[rows]), np.unique(self.var_codes[rows])
+
+    def batches(self, max_batch_size, skip=None, batch_over=None):
+        """
+        Yield (partitions, date_codes, var_codes) for groups of compatible partitions.
+
+        batch_over: id cols (e.g. CUT_ID) whose partitions are batched together
+            when the other id cols and the months match, on the union of their
+            vars. Cells a partition does not have are gathered as missing. Months
+            are never padded, a month missing from a partition is no time step.
+        """
+
+        members = defaultdict(list)
+        kept = [
+            i for i, col in enumerate(self.id_cols) if col not in (batch_over or [])
+        ]
+        for p in range(len(self)):
+            if skip is not None and skip[p]:
+                continue
+            dates, vars_ = self.signature(p)
+            if batch_over is None:
+                key = (dates.tobytes(), vars_.tobytes())
+            else:
+                key = (tuple(self.partition_key(p)[i] for i in kept), dates.tobytes())
+            members[key].append((p, dates, vars_))
+
+        groups = {}
+        for group_members in members.values():
+            dates = group_members[0][1]
+            vars_ = np.unique(np.concatenate([vars_ for _, _, vars_ in group_members]))
+            group = groups.setdefault(
+                (dates.tobytes(), vars_.tobytes()), (dates, vars_, [])
+            )
+            group[2].extend(p for p, _, _ in group_members)
+
+        for dates, vars_, partitions in groups.values():
+            for start in range(0, len(partitions), max_batch_size):
+                yield np.array(partitions[start : start + max_batch_size]), dates, vars_
+
+    def gather(self, partitions, date_codes, var_codes):
+        """Stacked wide batch: rows (ids..., date) partition-major, cols col x var"""
+
+        P, T, B = len(partitions), len(date_codes), len(var_codes)
+        rows = np.concatenate(
+            [self.order[self.starts[p] : self.ends[p]] for p in partitions]
+        )
+        # date_codes may be a trailing subset of the partitions' months
+        rows = rows[np.isin(self.date_codes[rows], date_codes)]
+
+        slots = np.empty(len(self), dtype=np.intp)
+        slots[partitions] = np.arange(P)
+        flat_positions = (
+            slots[self.partition_codes[rows]] * T
+            + np.searchsorted(date_codes, self.date_codes[rows])
+        ) * B + np.searchsorted(var_codes, self.var_codes[rows])
+
+        ids = self.partition_ids[partitions]
+        ids = (
+            ids.to_frame(index=False)
+            if isinstance(ids, pd.MultiIndex)
+            else pd.DataFrame({self.id_cols[0]: ids})
+        )
+        index = pd.MultiIndex.from_arrays(
+            [np.repeat(ids[col].to_numpy(), T) for col in self.id_cols]
+            + [np.tile(self.dates[date_codes], P)],
+            names=self.id_cols + [self.date_col],
+        )
+
+        vars_index = self.vars[var_codes]
+        frames = [
+            pd.DataFrame(
+                _scatter(
+                    self.table[col].to_numpy()[rows], flat_positions, P * T * B
+                ).reshape(P * T, B),
+                index=index,
+                columns=pd.MultiIndex.from_arrays(
+                    [[col] * B]
+                    + [
+                        vars_index.get_level_values(i)
+                        for i in range(vars_index.nlevels)
+                    ],
+                    names=[None] + self.var_cols,
+                ),
+            )
+            for col in self.value_cols
+        ]
+        return pd.concat(frames, axis=1)
+
+    def cell_mask(self, partitions, date_codes, var_codes):
+        """
+        Which cells of a gathered batch, in pivot_long row order, are in their
+        partition's own vars. None if all of them are.
+        """
+
+        own_vars = np.stack(
+            [np.isin(var_codes, self.signature(p)[1]) for p in partitions]
+        )
+        if own_vars.all():
+            return None
+        return np.repeat(own_vars[:, np.newaxis, :], len(date_codes), axis=1).reshape(
+            -1
+        )
+
+    def date_labels(self, date_codes):
+        return np.array([str(date) for date in self.dates[date_codes]])
+
+    def var_labels(self, var_codes):
+        return np.array([str(var) for var in self.vars[var_codes]])
+
+    def pivot_long(self, batch):
+        """Long frame, one row per (partition, month, var) cell of a stacked batch"""
+
+        vars_index = batch.columns.droplevel(0).unique()
+        PT, B = len(batch), len(vars_index)
+
+        long_df = batch.index.to_frame(index=False).iloc[np.repeat(np.arange(PT), B)]
+        long_df = long_df.reset_index(drop=True)
+
+        vars_df = vars_index.to_frame(index=False)
+        for i, var_col in enumerate(self.var_cols):
+            long_df[var_col] = np.tile(vars_df.iloc[:, i].to_numpy(), PT)
+
+        cols = batch.columns.get_level_values(0)
+        var_positions = vars_index.get_indexer(batch.columns.droplevel(0))
+        for col in cols.unique():
+            positions = np.flatnonzero(cols == col)
+            values = batch.iloc[:, positions].to_numpy()
+            # every var is present in every block of a batch, so scatter by position
+            block = np.empty((PT, B), dtype=values.dtype)
+            block[:, var_positions[positions]] = values
+            long_df[col] = block.reshape(-1)
+
+        return long_df
+
+
+# %%
+class FilterStateStore:
+    """
+    Trailing filtered states per (output col prefix, partition) as .npz files, so
+    monthly runs can resume the filter instead of starting from the first month.
+
+    Each file holds the months and vars (as strings) it covers plus xs (W, B) and
+    Ps (W, B[, B]).
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = Path(state_dir)
+
+    def _path(self, prefix, partition_key):
+        key = hashlib.sha256(repr(tuple(map(str, partition_key))).encode("utf-8"))
+        return self.state_dir / prefix / f"{key.hexdigest()}.npz"
+
+    def load(self, prefix, partition_key):
+        try:
+            with np.load(self._path(prefix, partition_key), allow_pickle=False) as f:
+                return {name: f[name] for name in f.files}
+        except FileNotFoundError:
+            return None
+
+    def save(self, prefix, partition_key, dates, vars_, xs, Ps):
+        path = self._path(prefix, partition_key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, dates=dates, vars=vars_, xs=xs, Ps=Ps)
+        os.replace(tmp_path, path)
+
+
+def _resume_window(states, date_labels, var_labels):
+    """(start, W) of the stored months within date_labels, None if not resumable"""
+
+    if not states or any(state is None for state in states):
+        return None
+
+    dates = states[0]["dates"]
+    W = len(dates)
+    for state in states:
+        if not np.array_equal(state["dates"], dates):
+            return None
+        if not np.array_equal(state["vars"], var_labels):
+            return None
+
+    start = np.flatnonzero(date_labels == dates[0]) if W else []
+    if len(start) != 1 or not np.array_equal(
+        date_labels[start[0] : start[0] + W], dates
+    ):
+        return None
+    return int(start[0]), W
+
+
+def _scalar_params(module):
+    # enough of a module's config to tell runs apart without pickling matrices
+    return {
+        key: value
+        for key, value in sorted(vars(module).items())
+        if isinstance(value, (bool, int, float, str, type(None)))
+    }
+
+
+def _init_params(callback):
+    # constructor arguments the callback keeps under the same name, so run state
+    # (e.g. Instrumentation's timings) never changes the fingerprint
+    params = inspect.signature(type(callback).__init__).parameters
+    values = {
+        name: getattr(callback, name) for name in params if hasattr(callback, name)
+    }
+    return {
+        name: value.__qualname__ if isinstance(value, type) else value
+        for name, value in sorted(values.items())
+        if isinstance(value, (type, bool, int, float, str, type(None)))
+    }
+
+
+class Checkpoint:
+    """
+    Finished long batches of a run as Parquet files, so a rerun after a crash skips
+    the partitions that were already done.
+
+    Files live under checkpoint_dir/<fingerprint>/, the fingerprint covering the
+    dataloader's table, its columns, the models' scalar parameters, the callbacks'
+    constructor arguments and the runner options that change outputs. Each file
+    lists its partition keys in the Parquet schema metadata. With clear_on_success
+    the files are removed after a run completes.
+    """
+
+    def __init__(self, checkpoint_dir, clear_on_success=True):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.clear_on_success = clear_on_success
+        self.path = None
+        self._paths = []
+
+    @staticmethod
+    def fingerprint(dataloader, models, **options):
+        digest = hashlib.sha256()
+        table = dataloader.table
+        digest.update(
+            pd.util.hash_pandas_object(table, index=False).to_numpy().tobytes()
+        )
+        config = {
+            "columns": [str(col) for col in table.columns],
+            "id_cols": list(dataloader.id_cols),
+            "date_col": dataloader.date_col,
+            "var_cols": list(dataloader.var_cols),
+            "models": [
+                [type(module).__name__, _scalar_params(module)]
+                for model in models
+                for module in getattr(model, "modules", [model])
+            ],
+            "options": options,
+        }
+        digest.update(json.dumps(config, sort_keys=True, default=str).encode("utf-8"))
+        return digest.hexdigest()
+
+    def begin(self, fingerprint):
+        """Start (or resume) a run, returning the keys of completed partitions"""
+
+        self.path = self.checkpoint_dir / fingerprint
+        self._paths.append(self.path)
+        completed = set()
+        for file in self.path.glob("*.parquet"):
+            metadata = pq.read_schema(file).metadata
+            completed.update(
+                tuple(key) for key in json.loads(metadata[b"partition_keys"])
+            )
+        return completed
+
+    def save(self, partition_keys, long_batch):
+        keys = [[str(k) for k in key] for key in partition_keys]
+        table = pa.Table.from_pandas(long_batch, preserve_index=False)
+        table = table.replace_schema_metadata(
+            {
+                **table.schema.metadata,
+                b"partition_keys": json.dumps(keys).encode("utf-8"),
+            }
+        )
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.path / f"{uuid.uuid4().hex}.parquet"
+        tmp_path = path.with_suffix(".tmp")
+        pq.write_table(table, tmp_path, compression="zstd")
+        os.replace(tmp_path, path)
+
+    def load(self):
+        """Long outputs of completed partitions, one frame per checkpointed batch"""
+
+        return [pd.read_parquet(file) for file in sorted(self.path.glob("*.parquet"))]
+
+    def clear(self):
+        """Remove the files of every dataloader begun since the last clear"""
+
+        for path in self._paths:
+            for file in path.glob("*.parquet"):
+                file.unlink()
+        self._paths = []
+
+
+def _bounded_map(executor, fn, items, max_pending):
+    """
+    Like executor.map over (key, args) items, in order, but with at most
+    max_pending items submitted at a time (executor.map consumes all of them).
+    """
+
+    pending = deque()
+    for key, args in items:
+        pending.append((key, args, executor.submit(fn, *args)))
+        if len(pending) >= max_pending:
+            key, args, future = pending.popleft()
+            yield key, args, future.result()
+    while pending:
+        key, args, future = pending.popleft()
+        yield key, args, future.result()
+
+
+# %%
+class BatchedRunner:
+    """
+    Replacement for fusion_kf Runner(callbacks=[PivotLong(), ConcactPartitions()])
+    that filters partitions with identical months and bizcates as one batch.
+
+    Callbacks get the same on_model_partition_start / on_model_partition_end hooks
+    as with fusion_kf, once per partition. partition.attrs holds the partition_key
+    and whatever the start hooks stored there, so callback state travels with the
+    partition. End hooks also get batch_seconds_share and batch_cpu_seconds_share,
+    the batch's filter time split evenly over its partitions, and
+    process_peak_rss_bytes, the filtering process's lifetime peak memory.
+    Callbacks may also define on_run_start(models, dataloaders),
+    on_run_end(models, output) and on_partitions_skipped(models, partition_keys),
+    called with the partitions a checkpoint already holds, which get no
+    partition hooks.
+    run returns the long, concatenated output.
+
+    With state_dir set, the last resmooth_window filtered states of every partition
+    are persisted after each run. incremental=True then resumes each partition
+    from its stored states: only months after them are filtered, the smoother
+    reruns over the stored window plus the new months, and only those months are
+    returned. Partitions without usable state (new partitions, changed bizcates or
+    history) are filtered in full. Callbacks that refit on the data they see, like
+    Scaler, would rescale the window differently, so they are refused with
+    incremental runs.
+
+    smoother_lag=N replaces the full RTS pass with a fixed-lag smoother: a month's
+    _RTS value only uses the next N months and is frozen after that, so with
+    incremental runs a resmooth_window above N returns every month that can move.
+
+    outputs selects the <prefix>_KF and <prefix>_RTS columns to produce, columns
+    left out are never allocated or pivoted.
+
+    With a sink (e.g. sinks.ParquetSink) every long batch is written out as soon
+    as it is finished instead of being concatenated, and run returns the sink's
+    lazy dataset handle.
+
+    With a checkpoint (Checkpoint) every finished batch is also saved, and a rerun
+    over the same inputs, models and options only filters the partitions that
+    are missing from it.
+
+    Parallel runs use executor when one is given (e.g. a pool shared by several
+    runners) and otherwise a ProcessPoolExecutor of n_jobs workers per run.
+
+    batch_over=["CUT_ID"] filters all cuts of a retailer/channel with the same
+    months as one batch even when their bizcates differ: they are gathered on the
+    union of the bizcates, bizcates a cut does not have are missing measurements
+    like any other missing cell (zero sample size, so next to no weight), and
+    only each cut's own bizcates are returned. More cuts then add batch rows
+    instead of batches and Q builds.
+    """
+
+    def __init__(
+        self,
+        callbacks=None,
+        max_batch_size=256,
+        n_jobs=None,
+        state_dir=None,
+        incremental=False,
+        resmooth_window=6,
+        smoother_lag=None,
+        outputs=OUTPUTS,
+        sink=None,
+        checkpoint=None,
+        executor=None,
+        batch_over=None,
+    ):
+        unknown = set(outputs) - set(OUTPUTS)
+        if unknown:
+            raise ValueError(
+                f"unknown outputs {sorted(unknown)}, expected some of {OUTPUTS}"
+            )
+
+        if incremental and state_dir is None:
+            raise ValueError("incremental runs need a state_dir")
+        fitting = [
+            type(cb).__name__
+            for cb in callbacks or []
+            if getattr(cb, "fits_on_data", False)
+        ]
+        if incremental and fitting:
+            raise ValueError(
+                "incremental runs can't use callbacks that fit on the data: "
+                + ", ".join(fitting)
+            )
+
+        self.callbacks = callbacks or []
+        self.max_batch_size = max_batch_size
+        self.n_jobs = n_jobs
+        self.state_store = (
+            FilterStateStore(state_dir) if state_dir is not None else None
+        )
+        self.incremental = incremental
+        self.resmooth_window = resmooth_window
+        self.smoother_lag = smoother_lag
+        self.outputs = tuple(outputs)
+        self.sink = sink
+        self.checkpoint = checkpoint
+        self.executor = executor
+        self.batch_over = list(batch_over) if batch_over is not None else None
+
+    def _call_run_hooks(self, hook, *args):
+        for callback in self.callbacks:
+            method = getattr(callback, hook, None)
+            if method is not None:
+                method(*args)
+
+    def _call_partition_hooks(
+        self, hook, models, panel, partitions, batch, extra_attrs=None
+    ):
+        if not self.callbacks:
+            return batch
+
+        # attrs set by start hooks (e.g. Scaler state) come back in the end hooks
+        partition_attrs = batch.attrs.get("partition_attrs") or [{}] * len(partitions)
+        extra_attrs = extra_attrs or {}
+
+        T = len(batch) // len(partitions)
+        hooked = []
+        for i, p in enumerate(partitions):
+            partition = batch.iloc[i * T : (i + 1) * T].copy()
+            partition.attrs = {
+                **partition_attrs[i],
+                **extra_attrs,
+                "partition_key": panel.partition_key(p),
+            }
+            for callback in self.callbacks:
+                method = getattr(callback, hook, None)
+                if method is not None:
+                    partition = method(models, partition)
+            hooked.append(partition)
+
+        hooked_batch = pd.concat(hooked)
+        hooked_batch.attrs = {
+            "partition_attrs": [partition.attrs for partition in hooked]
+        }
+        return hooked_batch
+
+    def _prefixes(self, models):
+        return [
+            output_col_prefix(module)
+            for model in models
+            for module in getattr(model, "modules", [model])
+        ]
+
+    def _resume_groups(self, models, panel, partitions, date_codes, var_codes):
+        """Split a batch into groups of partitions resuming from the same months"""
+
+        if not self.incremental:
+            yield partitions, date_codes, var_codes, None
+            return
+
+        prefixes = self._prefixes(models)
+        date_labels = panel.date_labels(date_codes)
+        var_labels = panel.var_labels(var_codes)
+
+        groups = defaultdict(list)
+        for p in partitions:
+            key = panel.partition_key(p)
+            states = [self.state_store.load(prefix, key) for prefix in prefixes]
+            groups[_resume_window(states, date_labels, var_labels)].append((p, states))
+
+        for window, members in groups.items():
+            group_partitions = np.array([p for p, _ in members])
+            if window is None:
+                yield group_partitions, date_codes, var_codes, None
+                continue
+
+            start, _ = window
+            priors = {
+                prefix: (
+                    np.stack([states[i]["xs"] for _, states in members]),
+                    np.stack([states[i]["Ps"] for _, states in members]),
+                )
+                for i, prefix in enumerate(prefixes)
+            }
+            yield group_partitions, date_codes[start:], var_codes, priors
+
+    def _save_states(self, panel, partitions, date_codes, var_codes, states):
+        dates = panel.date_labels(date_codes)
+        vars_ = panel.var_labels(var_codes)
+        for prefix, (xs, Ps) in states.items():
+            for i, p in enumerate(partitions):
+                self.state_store.save(
+                    prefix,
+                    panel.partition_key(p),
+                    dates[-xs.shape[1] :],
+                    vars_,
+                    xs[i],
+                    Ps[i],
+                )
+
+    def run(self, models, dataloaders, parallel=False):
+        if not isinstance(dataloaders, (list, tuple)):
+            dataloaders = [dataloaders]
+
+        self._call_run_hooks("on_run_start", models, dataloaders)
+        if self.sink is not None:
+            self.sink.open()
+
+        outputs = [self._run_dataloader(models, dl, parallel) for dl in dataloaders]
+        if self.checkpoint is not None and self.checkpoint.clear_on_success:
+            self.checkpoint.clear()
+
+        if self.sink is not None:
+            output = self.sink.dataset()
+        else:
+            output = pd.concat(outputs, ignore_index=True)
+
+        self._call_run_hooks("on_run_end", models, output)
+        return output
+
+    def _run_dataloader(self, models, dataloader, parallel):
+        panel = Panel(
+            dataloader.table,
+            id_cols=dataloader.id_cols,
+            date_col=dataloader.date_col,
+            var_cols=dataloader.var_cols,
+        )
+        if len(panel) == 0:
+            empty = self._empty_output(models, panel)
+            if self.sink is not None:
+                # sets the schema of the sink's dataset, no files are written
+                self.sink.write(empty)
+                return None
+            return empty
+
+        skip, long_batches = None, []
+        if self.checkpoint is not None:
+            completed = self.checkpoint.begin(
+                Checkpoint.fingerprint(
+                    dataloader,
+                    models,
+                    incremental=self.incremental,
+                    resmooth_window=self.resmooth_window,
+                    smoother_lag=self.smoother_lag,
+                    outputs=self.outputs,
+                    batch_over=self.batch_over,
+                    callbacks=[
+                        [type(callback).__name__, _init_params(callback)]
+                        for callback in self.callbacks
+                    ],
+                )
+            )
+            skip = np.array(
+                [
+                    tuple(map(str, panel.partition_key(p))) in completed
+                    for p in range(len(panel))
+                ],
+                dtype=bool,
+            )
+            if skip.any():
+                skipped = [panel.partition_key(p) for p in np.flatnonzero(skip)]
+                self._call_run_hooks("on_partitions_skipped", models, skipped)
+            long_batches = self.checkpoint.load() if skip.any() else []
+            if self.sink is not None:
+                for long_batch in long_batches:
+                    self.sink.write(long_batch)
+                long_batches = []
+
+        def gathered():
+            # batches are built one at a time as the filter asks for them
+            for group in panel.batches(
+                self.max_batch_size, skip=skip, batch_over=self.batch_over
+            ):
+                for partitions, date_codes, var_codes, priors in self._resume_groups(
+                    models, panel, *group
+                ):
+                    batch = panel.gather(partitions, date_codes, var_codes)
+                    batch = self._call_partition_hooks(
+                        "on_model_partition_start", models, panel, partitions, batch
+                    )
+                    yield (partitions, date_codes, var_codes), (
+                        batch,
+                        len(partitions),
+                        priors,
+                    )
+
+        filter_fn = partial(
+            _filter_batch_all_models,
+            models,
+            keep_last=self.resmooth_window if self.state_store is not None else 0,
+            smoother_lag=self.smoother_lag,
+            outputs=self.outputs,
+        )
+        # a shared executor is used as is and left running for its other users
+        owned = parallel and self.executor is None
+        executor = (
+            ProcessPoolExecutor(max_workers=self.n_jobs) if owned else self.executor
+        )
+        with executor if owned else nullcontext():
+            if parallel:
+                max_pending = 2 * (self.n_jobs or os.cpu_count() or 1)
+                results = _bounded_map(executor, filter_fn, gathered(), max_pending)
+            else:
+                results = ((key, args, filter_fn(*args)) for key, args in gathered())
+            long_batches += self._finish_batches(models, panel, results)
+
+        if self.sink is not None:
+            return None
+        if not long_batches:
+            return self._empty_output(models, panel)
+        return pd.concat(long_batches, ignore_index=True)
+
+    def _empty_output(self, models, panel):
+        # the columns (and key dtypes) a run over rows would have returned
+        keys = panel.id_cols + [panel.date_col] + panel.var_cols
+        empty = (
+            panel.table.loc[:, keys + panel.value_cols].iloc[:0].reset_index(drop=True)
+        )
+        for model in models:
+            for module in getattr(model, "modules", [model]):
+                for output in self.outputs:
+                    empty[f"{output_col_prefix(module)}_{output}"] = np.empty(0)
+        return empty
+
+    def _finish_batches(self, models, panel, results):
+        # results are consumed as they arrive and every batch is dropped once
+        # written, so with a sink only the batches in flight are held (one when
+        # serial, max_pending in parallel)
+        long_batches = []
+        for (partitions, date_codes, var_codes), (batch, *_), filtered in results:
+            outputs, states, stats = filtered
+            if self.state_store is not None:
+                self._save_states(panel, partitions, date_codes, var_codes, states)
+            batch = _append_outputs(batch, outputs)
+
+            # only whole batches are timed, each partition gets an even share
+            P = len(partitions)
+            batch_stats = {
+                "batch_size": P,
+                "batch_seconds_share": stats["batch_seconds"] / P,
+                "batch_cpu_seconds_share": stats["batch_cpu_seconds"] / P,
+                "process_peak_rss_bytes": stats["process_peak_rss_bytes"],
+            }
+            batch = self._call_partition_hooks(
+                "on_model_partition_end", models, panel, partitions, batch, batch_stats
+            )
+            long_batch = panel.pivot_long(batch)
+            if self.batch_over is not None:
+                mask = panel.cell_mask(partitions, date_codes, var_codes)
+                if mask is not None:
+                    long_batch = long_batch[mask].reset_index(drop=True)
+            if self.checkpoint is not None:
+                self.checkpoint.save(
+                    [panel.partition_key(p) for p in partitions], long_batch
+                )
+            if self.sink is not None:
+                self.sink.write(long_batch)
+            else:
+                long_batches.append(long_batch)
+
+        return long_batches
@@ -1,6 +1,9 @@
 # %%
 # %%
 import os
+import functools
+import threading
+from collections import OrderedDict
 
 # os.environ["PANDAS_COPY_ON_WRITE"] = "1"
 
@@ -14,9 +17,21 @@ from fusion_kf import KFModule
 from siuba import *
 import numpy as np
 from db import fdb
+from cache import cached_collect, expired, CACHE_DIR, CACHE_TTL
 import pyarrow as pa
 
 # %%
+# the .npy matrix is rebuilt once older than this, like the collect cache it
+# is built from
+CORR_MATRIX_TTL = float(os.getenv("BIZCATE_CORR_MATRIX_TTL", CACHE_TTL))  # seconds
+
+
+def default_corr_matrix_path():
+    """BIZCATE_CORR_MATRIX_NPY (read at call time), else next to the collect cache"""
+
+    return os.getenv(
+        "BIZCATE_CORR_MATRIX_NPY", str(CACHE_DIR.parent / "bizcate_corr_matrix.npy")
+    )
 
 
 def full_bizcat_corr_matrix():
@@ -24,7 +39,7 @@ def full_bizcat_corr_matrix():
         fdb.FUSEDDATA.LEVER_BRAND.BIZCATE_THINK_CORRELATION(lazy=True)
         >> select(_.BIZCATE_CODE, _.SIMILAR_BIZCATE_CODE, _.CORRELATION)
         >> arrange(_.BIZCATE_CODE, _.SIMILAR_BIZCATE_CODE)
-        >> collect()
+        >> cached_collect()
     ).set_index(["BIZCATE_CODE", "SIMILAR_BIZCATE_CODE"])
 
     bizcats_with_corr = corr_bizcats_df.index.get_level_values("BIZCATE_CODE").unique()
@@ -39,27 +54,168 @@ def full_bizcat_corr_matrix():
     corr_all_bizcats_df = (
         corr_bizcats_df.reindex(multi_index, fill_value=0)  # FIXME: temp imputation
         .reset_index()
-        .pivot_table(index="BIZCATE_CODE", columns="SIMILAR_BIZCATE_CODE", values="CORRELATION")
+        .pivot_table(
+            index="BIZCATE_CODE", columns="SIMILAR_BIZCATE_CODE", values="CORRELATION"
+        )
     )
 
     return corr_all_bizcats_df
 
 
-# %%
+def _corr_codes_path(npy_path):
+    root, _ = os.path.splitext(npy_path)
+    return root + "_codes.npy"
+
+
+def save_bizcat_corr_matrix(corr_all_bizcats_df, npy_path):
+    """Write the square matrix and its bizcate codes as .npy files"""
+
+    os.makedirs(os.path.dirname(os.path.abspath(npy_path)), exist_ok=True)
+    for path, arr in [
+        (npy_path, corr_all_bizcats_df.to_numpy(dtype=np.float64)),
+        (_corr_codes_path(npy_path), corr_all_bizcats_df.index.to_numpy()),
+    ]:
+        # write to a temp file first so concurrent workers never map partial files
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(arr))
+        os.replace(tmp_path, path)
+
+
+def load_bizcat_corr_matrix(npy_path):
+    """Memory-map a matrix written by save_bizcat_corr_matrix (no copy is made)"""
+
+    values = np.load(npy_path, mmap_mode="r")
+    codes = np.load(_corr_codes_path(npy_path))
+    return pd.DataFrame(
+        values,
+        index=pd.Index(codes, name="BIZCATE_CODE"),
+        columns=pd.Index(codes, name="SIMILAR_BIZCATE_CODE"),
+        copy=False,
+    )
+
+
+def _corr_matrix_expired(npy_path, ttl=CORR_MATRIX_TTL):
+    try:
+        written = min(
+            os.path.getmtime(npy_path), os.path.getmtime(_corr_codes_path(npy_path))
+        )
+    except FileNotFoundError:
+        return True
+    return expired(written, ttl)
+
+
+_corr_matrix_lock = threading.Lock()
+
+# bounded LRU of Q matrices shared by every module instance in the process, keyed
+# by (corr_matrix_path, process_std, bizcate tuple), so unpickled copies in
+# process-pool workers keep hitting it from batch to batch. Q itself is cached,
+# not a Cholesky factor of it: kf_engine only ever adds Q to P and solves
+# against P + Q (or P + R), which changes every step, so a factor of Q alone
+# would never be used.
+PROCESS_COV_CACHE_SIZE = int(os.getenv("BIZCATE_PROCESS_COV_CACHE_SIZE", 256))
+_process_cov_cache = OrderedDict()
+_process_cov_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def shared_bizcat_corr_matrix(npy_path=None):
+    """
+    Process-wide bizcate correlation matrix, loaded once per process.
+
+    If npy_path is given the matrix is memory-mapped from it (and written there on
+    first use, or once older than CORR_MATRIX_TTL or invalidated with the collect
+    cache), so process-pool workers share the same pages instead of copies.
+
+    Every (re)load, i.e. the first call and the first one after cache_clear, also
+    drops the Q matrices built from the previous one.
+    """
+
+    # concurrent first calls all miss the lru_cache, the lock makes the later ones
+    # wait and map the file the first one wrote instead of fetching it again
+    with _corr_matrix_lock:
+        with _process_cov_lock:
+            for key in [key for key in _process_cov_cache if key[0] == npy_path]:
+                del _process_cov_cache[key]
+
+        if npy_path is None:
+            return full_bizcat_corr_matrix()
+
+        if _corr_matrix_expired(npy_path):
+            save_bizcat_corr_matrix(full_bizcat_corr_matrix(), npy_path)
+
+        return load_bizcat_corr_matrix(npy_path)
+
+
 class BizcateCorrelationKFModule(KFModule):
     def __init__(
-        self, *, metric_col, output_col_prefix=None, sample_size_col, process_std
+        self,
+        *,
+        metric_col,
+        output_col_prefix=None,
+        sample_size_col,
+        process_std,
+        corr_matrix_path=None,
+        diagonal_measurement=False,
     ):
         self.sample_size_col = sample_size_col
         self.process_std = process_std
-        self.corr_all_bizcats_df = full_bizcat_corr_matrix()
+        # return (T, B) variances instead of dense (T, B, B) covariances,
+        # for use with kf_engine which has a diagonal update path
+        self.diagonal_measurement = diagonal_measurement
+        # None: BIZCATE_CORR_MATRIX_NPY if set, else the matrix is kept in memory
+        if corr_matrix_path is None:
+            corr_matrix_path = os.getenv("BIZCATE_CORR_MATRIX_NPY")
+        self.corr_matrix_path = corr_matrix_path
+        self.corr_all_bizcats_df = shared_bizcat_corr_matrix(corr_matrix_path)
+        self._init_process_cov_lookup()
         super().__init__(metric_col=metric_col, output_col_prefix=output_col_prefix)
 
+    def _init_process_cov_lookup(self):
+        # dense BIZCATE_CODE -> matrix position array (-1 for unknown codes)
+        codes = self.corr_all_bizcats_df.index.to_numpy()
+        self._code_positions = np.full(codes.max() + 1, -1, dtype=np.intp)
+        self._code_positions[codes] = np.arange(len(codes))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # workers re-map the shared .npy file instead of unpickling a copy
+        if self.corr_matrix_path is not None:
+            state["corr_all_bizcats_df"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.corr_all_bizcats_df is None:
+            self.corr_all_bizcats_df = shared_bizcat_corr_matrix(self.corr_matrix_path)
+
     def process_covariance(self, raw_df):
         bizcats = raw_df.columns.get_level_values("BIZCATE_CODE").unique().to_numpy()
-        corr_bizcats = self.corr_all_bizcats_df.loc[bizcats, bizcats].to_numpy()
+        key = tuple(bizcats.tolist())
+        cache_key = (self.corr_matrix_path, self.process_std, key)
+
+        with _process_cov_lock:
+            cov_bizcats = _process_cov_cache.get(cache_key)
+            if cov_bizcats is not None:
+                _process_cov_cache.move_to_end(cache_key)
+                return cov_bizcats
+
+        in_range = bizcats < len(self._code_positions)
+        positions = self._code_positions[np.where(in_range, bizcats, 0)]
+        if not in_range.all() or (positions < 0).any():
+            raise KeyError(f"BIZCATE_CODEs missing from correlation matrix: {key}")
+
+        corr_bizcats = self.corr_all_bizcats_df.to_numpy()[np.ix_(positions, positions)]
         # Q_bizcats (across bizcats)
         cov_bizcats = corr_bizcats * (self.process_std**2)
+        # shared between partitions, so guard against in-place edits
+        cov_bizcats.setflags(write=False)
+
+        with _process_cov_lock:
+            _process_cov_cache[cache_key] = cov_bizcats
+            if len(_process_cov_cache) > PROCESS_COV_CACHE_SIZE:
+                _process_cov_cache.popitem(last=False)
+
         return cov_bizcats
 
     def measurement_covariance(self, raw_df):
@@ -71,5 +227,40 @@ class BizcateCorrelationKFModule(KFModule):
 
         se = np.sqrt(np.abs(zs * (1 - zs) + 1e-8) / (ns + 1e-8)) + np.sqrt(0.25 / (ns + 1e-8))  # fmt: skip
         se_2 = se**2
+        if self.diagonal_measurement:
+            return se_2
+
         Rs = np.eye(se_2.shape[1]) * se_2[:, np.newaxis, :]
         return Rs
+
+
+# %%
+class FusedKFModule:
+    """
+    Filters several metric cols with the same module configuration in one pass.
+
+    Each metric gets its own module_cls instance (and output prefix), but Q and the
+    partition gather are shared and kf_engine runs all metrics as one batch.
+    """
+
+    def __init__(
+        self, module_cls, *, metric_cols, output_col_suffix="", **module_kwargs
+    ):
+        self.metric_cols = list(metric_cols)
+        self.modules = [
+            module_cls(
+                metric_col=metric_col,
+                output_col_prefix=metric_col + output_col_suffix,
+                **module_kwargs,
+            )
+            for metric_col in self.metric_cols
+        ]
+
+    def process_covariance(self, raw_df):
+        # Q only depends on the bizcates and process_std, not on the metric
+        return self.modules[0].process_covariance(raw_df)
+
+    def measurement_covariance(self, raw_df):
+        return np.stack(
+            [module.measurement_covariance(raw_df) for module in self.modules]
+        )
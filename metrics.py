@@ -0,0 +1,487 @@
+# %%
+import pandas as pd
+from db import fdb
+from cache import cached_collect
+from siuba import *
+from siuba.dply.vector import *
+from siuba.experimental.pivot import pivot_longer
+from callbacks import Scaler, SCALER_CACHE_DIR
+from pipeline import MetricSpec, Source
+from sklearn.preprocessing import PowerTransformer
+from utils import logit, complete_table, compact
+
+
+# %% Define input parameters
+
+# fmt: off
+# Define cuts to process (in addition to National) for the by retailer tables
+CUT_IDS = [
+    2, 3,
+]
+# fmt: on
+
+
+# %% loaders, one warehouse read each
+def load_percent_yes(
+    table,
+    metric_col,
+    database="L2SURVEY",
+    schema="BIZCATE_ROLLUP",
+    cut_ids=None,
+    logit_transform=True,
+):
+    """A002 Q23 bodies, A003 Q23 spend"""
+
+    percent_yes = (
+        fdb[database][schema][table](lazy=True)
+        # TODO: temp fix
+        >> rename(
+            MONTH_NUM=_.MONTH,
+            BIZCATE_CODE=_.SUB_CODE,
+        )
+        >> filter(
+            ~_.OPTION.isna(),
+            ~_.CUT_ID.isna(),
+            _.CUT_ID.isin([1] + cut_ids) if cut_ids is not None else True,
+        )
+        >> select(
+            _.CUT_ID,
+            _.BIZCATE_CODE,
+            _.OPTION,
+            _.MONTH_NUM,
+            _.ASK_COUNT,
+            _.ASK_WEIGHT,
+            metric_col,
+        )
+        >> cached_collect()
+    )
+    percent_yes = compact(percent_yes, name=table)
+
+    if logit_transform:
+        percent_yes[metric_col] = logit(percent_yes[metric_col])
+
+    return percent_yes
+
+
+def load_research_purpose(
+    table,
+    database="L2SURVEY",
+    schema="BIZCATE_ROLLUP",
+    cut_ids=None,
+    logit_transform=True,
+    retailer=False,
+):
+    """A099/A100 Q42a online research purpose (brick/ecom), A118 Q40 trip (retailer=True)"""
+
+    research_purpose = (
+        fdb[database][schema][table](lazy=True)
+        >> rename(
+            BIZCATE_CODE=_.SUB_CODE,
+        )
+        >> filter(
+            ~_.CUT_ID.isna(),
+            _.CUT_ID.isin([1] + cut_ids) if cut_ids is not None else True,
+        )
+        >> select(
+            _.CUT_ID,
+            _.BIZCATE_CODE,  # FIXME: ?
+            *([_.RETAILER_CODE] if retailer else []),
+            _.OPTION,
+            _.MONTH_NUM,
+            _.ASK_COUNT,
+            _.ASK_WEIGHT,
+            _.PERCENT_YES,
+        )
+        >> cached_collect()
+    )
+    research_purpose = compact(research_purpose, name=table)
+
+    if logit_transform:
+        research_purpose["PERCENT_YES"] = logit(research_purpose["PERCENT_YES"])
+
+    return research_purpose
+
+
+def load_avgspend(
+    table,
+    database="L2SURVEY",
+    schema="BIZCATE_ROLLUP",
+    cut_ids=None,
+):
+    """A018/A019 average spend (brick/ecom)"""
+
+    avgspend = (
+        fdb[database][schema][table](lazy=True)
+        # TODO: temp fix
+        >> rename(
+            MONTH_NUM=_.MONTH,
+            BIZCATE_CODE=_.SUB_CODE,
+        )
+        >> filter(
+            ~_.CUT_ID.isna(),
+            _.CUT_ID.isin([1] + cut_ids) if cut_ids is not None else True,
+        )
+        >> select(
+            _.CUT_ID,
+            _.BIZCATE_CODE,
+            _.MONTH_NUM,
+            _.ASK_COUNT,
+            _.ASK_WEIGHT,
+            _.AVG_SPEND,
+        )
+        >> cached_collect()
+    )
+    avgspend = compact(avgspend, name=table)
+
+    return avgspend
+
+
+def load_roc(
+    table,
+    database="L2SURVEY",
+    schema="BIZCATE_ROLLUP",
+    cut_ids=None,
+    logit_transform=True,
+):
+    """A050 by retailer omnibase ROC (brick/ecom), one SCORE row per METRIC"""
+
+    roc = (
+        fdb[database][schema][table](lazy=True)
+        # TODO: temp fix
+        >> rename(
+            MONTH_NUM=_.MONTH,
+            BIZCATE_CODE=_.SUB_CODE,
+        )
+        >> filter(
+            ~_.CUT_ID.isna(),
+            _.CUT_ID.isin([1] + cut_ids) if cut_ids is not None else True,
+            # _.IMPUTED == 0, # TODO: ?
+        )
+        >> select(
+            _.IMPUTED,
+            _.CUT_ID,
+            _.BIZCATE_CODE,
+            _.RETAILER_CODE,
+            _.MONTH_NUM,
+            _.ASK_COUNT,
+            _.ASK_WEIGHT_SPEND,
+            _.TA == _.PERCENT_SPEND_FINAL_TA_AND_SHARE_ADJUSTED_11,
+            _.THINK == _.PERCENT_SPEND_FINAL_TA_AND_SHARE_ADJUSTED_12,
+            _.CONSIDER == _.PERCENT_SPEND_FINAL_TA_AND_SHARE_ADJUSTED_13,
+            _.VISIT == _.PERCENT_SPEND_FINAL_TA_AND_SHARE_ADJUSTED_14,
+            _.SHARE == _.PERCENT_SPEND_FINAL_TA_AND_SHARE_ADJUSTED_16,
+        )
+        >> pivot_longer(
+            _["TA", "THINK", "CONSIDER", "VISIT", "SHARE"],
+            names_to="METRIC",
+            values_to="SCORE",
+        )
+        >> cached_collect()
+    )
+    roc = compact(roc, name=table)
+
+    if logit_transform:
+        roc["SCORE"] = logit(roc["SCORE"])
+
+    return roc
+
+
+def fetch_raw_think_tom(
+    db, schema, tbl_name, retailers, channel, logit_transform, cut_ids=None
+):
+    # Define the think table, filter and collect (months stay MONTH_NUM)
+    think = (
+        fdb[db][schema][tbl_name](lazy=True)
+        >> filter(
+            _.TOTALTHINK.notna(),
+            _.CUT_ID.isin([1] + cut_ids) if cut_ids is not None else True,
+            _.RETAILER_CODE.isin(retailers) if retailers is not None else True,
+        )
+        >> select(
+            _.CUT_ID,
+            _.SUB_CODE,
+            _.RETAILER_CODE,
+            _.MONTH_NUM,
+            _.ASK_COUNT,
+            _.ASK_WEIGHT,
+            _.TOM,
+            _.TOTALTHINK,
+        )
+        >> cached_collect()
+    )
+    think = compact(think, name=tbl_name)
+
+    # Derive the distinct think counts locally from the same scan
+    think_counts = (
+        think
+        >> distinct(_.CUT_ID, _.SUB_CODE, _.MONTH_NUM, _.ASK_COUNT, _.ASK_WEIGHT)
+        >> rename(FILL_ASK_COUNT="ASK_COUNT", FILL_ASK_WEIGHT="ASK_WEIGHT")
+    )
+
+    # Ensure that the table is complete (set missing entries to 0 ask count and 0 share)
+    completed_think = complete_table(
+        df=think,
+        identifying_cols=["CUT_ID", "SUB_CODE", "RETAILER_CODE"],
+        date_col="MONTH_NUM",
+        fill_values={"TOM": 0, "TOTALTHINK": 0},
+    )
+
+    # Join the fill ask counts and weights, and set any remaining missing counts and weights to 0
+    completed_think = (
+        completed_think
+        >> left_join(_, think_counts, on=["CUT_ID", "SUB_CODE", "MONTH_NUM"])
+        >> mutate(
+            ASK_COUNT=case_when(
+                {
+                    _.ASK_COUNT.notna(): _.ASK_COUNT,
+                    _.ASK_COUNT.isna() & _.FILL_ASK_COUNT.notna(): _.FILL_ASK_COUNT,
+                    True: 0,
+                }
+            )
+        )
+        >> mutate(
+            ASK_WEIGHT=case_when(
+                {
+                    _.ASK_WEIGHT.notna(): _.ASK_WEIGHT,
+                    _.ASK_WEIGHT.isna() & _.FILL_ASK_WEIGHT.notna(): _.FILL_ASK_WEIGHT,
+                    True: 0,
+                }
+            )
+        )
+    )
+
+    # # Set the channel column and re-order
+    completed_think["CHANNEL"] = channel
+    completed_think = completed_think[
+        [
+            "CHANNEL",
+            "RETAILER_CODE",
+            "SUB_CODE",
+            "MONTH_NUM",
+            "ASK_COUNT",
+            "ASK_WEIGHT",
+            "TOM",
+            "TOTALTHINK",
+            "CUT_ID",
+        ]
+    ]
+    completed_think = completed_think.sort_values(
+        by=["CUT_ID", "RETAILER_CODE", "SUB_CODE", "MONTH_NUM"]
+    )
+
+    # Convert to logit space if specified in the function call
+    if logit_transform:
+        completed_think["TOM"] = logit(completed_think["TOM"])
+        completed_think["TOTALTHINK"] = logit(completed_think["TOTALTHINK"])
+
+    return completed_think
+
+
+def fetch_raw_market_share(
+    db, schema, tbl_name, retailers, channel, logit_transform, cut_ids=None
+):
+    # Define the market share table, filter and collect (months stay MONTH_NUM)
+    market_share = (
+        fdb[db][schema][tbl_name](lazy=True)
+        >> filter(
+            _.SHARE_FINAL.notna(),
+            _.CUT_ID.isin([1] + cut_ids) if cut_ids is not None else True,
+            _.RETAILER_CODE.isin(retailers) if retailers is not None else True,
+        )
+        >> select(
+            _.CUT_ID,
+            _.SUB_CODE,
+            _.RETAILER_CODE,
+            _.MONTH_NUM,
+            _.ASK_COUNT,
+            _.ASK_WEIGHT,
+            _.SHARE_FINAL,
+        )
+        >> cached_collect()
+    )
+    market_share = compact(market_share, name=tbl_name)
+
+    # Ensure that the table is complete (set missing entries to 0 ask count and 0 share)
+    completed_market_share = complete_table(
+        df=market_share,
+        identifying_cols=["CUT_ID", "SUB_CODE", "RETAILER_CODE"],
+        date_col="MONTH_NUM",
+        fill_values={"ASK_COUNT": 0, "ASK_WEIGHT": 0, "SHARE_FINAL": 0},
+    )
+
+    # Set the channel column and re-order
+    completed_market_share["CHANNEL"] = channel
+    completed_market_share = completed_market_share[
+        [
+            "CHANNEL",
+            "RETAILER_CODE",
+            "SUB_CODE",
+            "MONTH_NUM",
+            "ASK_COUNT",
+            "ASK_WEIGHT",
+            "SHARE_FINAL",
+            "CUT_ID",
+        ]
+    ]
+    completed_market_share = completed_market_share.sort_values(
+        by=["CUT_ID", "RETAILER_CODE", "SUB_CODE", "MONTH_NUM"]
+    )
+
+    # Convert to logit space if specified in the function call
+    if logit_transform:
+        completed_market_share["SHARE_FINAL"] = logit(
+            completed_market_share["SHARE_FINAL"]
+        )
+
+    # Return the dataframe
+    return completed_market_share
+
+
+def load_awareness(cut_ids=CUT_IDS, logit_transform=True):
+    """A036/A037 by retailer awareness, bm and ecom stacked"""
+
+    think = [
+        fetch_raw_think_tom(
+            db="L2SURVEY",
+            schema="BIZCATE_ROLLUP",
+            tbl_name=tbl_name,
+            retailers=None,
+            channel=channel,
+            logit_transform=logit_transform,
+            cut_ids=cut_ids,
+        )
+        for tbl_name, channel in [
+            ("A036_BYRETAILER_BMAWARENESS", "BM"),
+            ("A037_BYRETAILER_ECOMAWARENESS", "Ecom"),
+        ]
+    ]
+    # CHANNEL is only added after collect
+    return compact(pd.concat(think) >> rename(BIZCATE_CODE=_.SUB_CODE))
+
+
+def load_marketshare(cut_ids=CUT_IDS, logit_transform=True):
+    """A043/A046 by retailer market share, bm and ecom stacked"""
+
+    market_share = [
+        fetch_raw_market_share(
+            db="L2SURVEY",
+            schema="BIZCATE_ROLLUP",
+            tbl_name=tbl_name,
+            retailers=None,
+            channel=channel,
+            logit_transform=logit_transform,
+            cut_ids=cut_ids,
+        )
+        for tbl_name, channel in [
+            ("A043_BYRETAILER_BMBASE_MARKETSHARE", "BM"),
+            ("A046_BYRETAILER_ECOMBASE_MARKETSHARE", "Ecom"),
+        ]
+    ]
+    market_share = pd.concat(market_share) >> rename(
+        BIZCATE_CODE=_.SUB_CODE, MARKET_SHARE=_.SHARE_FINAL
+    )
+    # CHANNEL is only added after collect
+    return compact(market_share)
+
+
+# %% one spec per model table
+# fmt: off
+SPECS = [
+    MetricSpec(
+        name="a002_q23bodies",
+        source=Source(load_percent_yes, table="A002_Q23BODIES", metric_col="PERCENT_YES_BODIES"),
+        id_cols=["CUT_ID", "OPTION"],
+        metric_cols=["PERCENT_YES_BODIES"],
+        upload_table="BIZCATE_M002_Q23BODIES",
+    ),
+    MetricSpec(
+        name="a003_q23spend",
+        source=Source(load_percent_yes, table="A003_Q23SPEND", metric_col="PERCENT_YES_SPEND"),
+        id_cols=["CUT_ID", "OPTION"],
+        metric_cols=["PERCENT_YES_SPEND"],
+        upload_table="BIZCATE_M003_Q23SPEND",
+    ),
+    MetricSpec(
+        name="a018_avgspend_bm",
+        source=Source(load_avgspend, table="A018_AVGSPEND_BM"),
+        id_cols=["CUT_ID"],
+        metric_cols=["AVG_SPEND"],
+        upload_table=None,  # TODO: not uploaded yet
+        process_std=0.030,
+        logit_transform=False,
+        clip_lower=0,
+        outputs=("KF", "RTS"),
+        callbacks=[
+            Scaler(
+                PowerTransformer,
+                method="yeo-johnson",
+                cache_dir=SCALER_CACHE_DIR,
+                name="a018_avgspend_bm",
+            ),
+        ],
+    ),
+    MetricSpec(
+        name="a019_avgspend_ecom",
+        source=Source(load_avgspend, table="A019_AVGSPEND_ECOM"),
+        id_cols=["CUT_ID"],
+        metric_cols=["AVG_SPEND"],
+        upload_table="BIZCATE_M019_AVGSPEND_ECOM",
+        process_std=0.030,
+        logit_transform=False,
+        clip_lower=0,
+        outputs=("KF", "RTS"),
+        callbacks=[Scaler()],
+    ),
+    MetricSpec(
+        name="a036_037_awareness",
+        source=Source(load_awareness),
+        id_cols=["CUT_ID", "CHANNEL", "RETAILER_CODE"],
+        metric_cols=["TOM", "TOTALTHINK"],
+        upload_table="BIZCATE_M036_037_AWARENESS",
+    ),
+    MetricSpec(
+        name="a043_046_marketshare",
+        source=Source(load_marketshare),
+        id_cols=["CUT_ID", "CHANNEL", "RETAILER_CODE"],
+        metric_cols=["MARKET_SHARE"],
+        upload_table="BIZCATE_M043_046_MARKETSHARE",
+    ),
+    MetricSpec(
+        name="a050_byretailer_omnibase_bmroc",
+        source=Source(load_roc, table="A050_BYRETAILER_OMNIBASE_BMROC"),
+        id_cols=["IMPUTED", "CUT_ID", "RETAILER_CODE", "METRIC"],
+        metric_cols=["SCORE"],
+        upload_table="BIZCATE_M050_BMROC",
+    ),
+    MetricSpec(
+        name="a050_byretailer_omnibase_ecomroc",
+        source=Source(load_roc, table="A050_BYRETAILER_OMNIBASE_ECOMROC"),
+        id_cols=["IMPUTED", "CUT_ID", "RETAILER_CODE", "METRIC"],
+        metric_cols=["SCORE"],
+        upload_table="BIZCATE_M050_ECOMROC",
+    ),
+    MetricSpec(
+        name="a099_q42research_purpose_bm",
+        source=Source(load_research_purpose, table="A099_Q42RESEARCH_PURPOSE_BM"),
+        id_cols=["CUT_ID", "OPTION"],
+        metric_cols=["PERCENT_YES"],
+        upload_table="BIZCATE_M099_Q42RESEARCH_PURPOSE_BM",
+        process_std=0.015,
+    ),
+    MetricSpec(
+        name="a100_q42research_purpose_ecom",
+        source=Source(load_research_purpose, table="A100_Q42RESEARCH_PURPOSE_ECOM"),
+        id_cols=["CUT_ID", "OPTION"],
+        metric_cols=["PERCENT_YES"],
+        upload_table="BIZCATE_M100_Q42RESEARCH_PURPOSE_ECOM",
+        process_std=0.015,
+    ),
+    MetricSpec(
+        name="a118_q40trip",
+        source=Source(load_research_purpose, table="A118_Q40TRIP", retailer=True),
+        id_cols=["CUT_ID", "OPTION", "RETAILER_CODE"],
+        metric_cols=["PERCENT_YES"],
+        upload_table="BIZCATE_M118_Q40TRIP",
+    ),
+]
+# fmt: on
@@ -0,0 +1,570 @@
+# %%
+import os
+from pathlib import Path
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+import numpy as np
+import pandas as pd
+from fusion_kf import DataLoader
+from fusion_kf.kf_modules import NoCorrelationKFModule
+from kf_modules import (
+    BizcateCorrelationKFModule,
+    FusedKFModule,
+    default_corr_matrix_path,
+    shared_bizcat_corr_matrix,
+)
+from kf_engine import BatchedRunner, Checkpoint
+from cache import invalidate_cache
+from db import month_lookup, with_month_year
+from upload import SnowflakeBackend, UploadQueue
+from utils import inv_logit, compact
+
+
+# %%
+PIPELINE_DIR = Path(
+    os.getenv(
+        "BIZCATE_PIPELINE_DIR", Path.home() / ".cache" / "bizcate_model" / "pipeline"
+    )
+)
+STATE_DIR = PIPELINE_DIR / "state"
+CHECKPOINT_DIR = PIPELINE_DIR / "checkpoint"
+
+
+# %%
+class Source:
+    """
+    A warehouse read: loader(**kwargs) returning a DataFrame.
+
+    Sources with the same loader and kwargs are the same read, so specs sharing
+    one are only loaded once per pipeline run.
+    """
+
+    def __init__(self, loader, **kwargs):
+        self.loader = loader
+        self.kwargs = kwargs
+
+    @property
+    def key(self):
+        kwargs = ", ".join(f"{k}={v!r}" for k, v in sorted(self.kwargs.items()))
+        return f"{self.loader.__module__}.{self.loader.__qualname__}({kwargs})"
+
+    def load(self):
+        return self.loader(**self.kwargs)
+
+
+class MetricSpec:
+    """
+    Everything that differs between the bizcate model scripts.
+
+    The source table holds the national cut (cut_col == national_cut_id) and the
+    demo cuts. Nationals are filtered directly, demo cuts as deltas to national
+    (national - demo) and recombined afterwards. metric_cols are filtered together
+    with FusedKFModule, once without and once with bizcate correlation.
+
+    float32=True uploads the metric and output columns as float32.
+
+    resmooth_window is the number of stored months incremental pipeline runs
+    resmooth (see BatchedRunner).
+
+    corr_matrix_path is the .npy file the bizcate correlation matrix is shared
+    through, default_corr_matrix_path() by default, so process-pool workers map it
+    instead of unpickling a copy with every batch.
+
+    date_col is the integer MONTH_NUM throughout, the model tables are keyed by
+    upload_date_col (MONTH_YEAR), which is only looked up for the upload.
+    """
+
+    def __init__(
+        self,
+        name,
+        source,
+        id_cols,
+        metric_cols,
+        upload_table=None,
+        process_std=0.020,
+        logit_transform=True,
+        clip_lower=None,
+        outputs=("RTS",),
+        callbacks=None,
+        smoother_lag=None,
+        resmooth_window=6,
+        sample_size_col="ASK_COUNT",
+        cut_col="CUT_ID",
+        national_cut_id=1,
+        date_col="MONTH_NUM",
+        var_cols=("BIZCATE_CODE",),
+        float32=False,
+        upload_date_col="MONTH_YEAR",
+        corr_matrix_path=None,
+    ):
+        self.name = name
+        self.source = source
+        self.id_cols = list(id_cols)
+        self.metric_cols = list(metric_cols)
+        self.upload_table = upload_table
+        self.process_std = process_std
+        self.logit_transform = logit_transform
+        self.clip_lower = clip_lower
+        self.outputs = tuple(outputs)
+        self.callbacks = callbacks or []
+        self.smoother_lag = smoother_lag
+        self.resmooth_window = resmooth_window
+        self.sample_size_col = sample_size_col
+        self.cut_col = cut_col
+        self.national_cut_id = national_cut_id
+        self.date_col = date_col
+        self.var_cols = list(var_cols)
+        self.float32 = float32
+        self.upload_date_col = upload_date_col
+        self.corr_matrix_path = corr_matrix_path
+
+    @property
+    def fits_on_data(self):
+        """Whether a callback fits on the data it sees, e.g. Scaler"""
+
+        return any(getattr(cb, "fits_on_data", False) for cb in self.callbacks)
+
+    @property
+    def join_cols(self):
+        """Columns matching a demo cut row to its national row"""
+
+        ids = [col for col in self.id_cols if col != self.cut_col]
+        return ids + [self.date_col] + self.var_cols
+
+    def models(self, metric_cols):
+        kwargs = dict(
+            sample_size_col=self.sample_size_col, process_std=self.process_std
+        )
+        corr_matrix_path = self.corr_matrix_path or default_corr_matrix_path()
+        return [
+            FusedKFModule(
+                NoCorrelationKFModule,
+                metric_cols=metric_cols,
+                output_col_suffix="_NO_CORR",
+                **kwargs,
+            ),
+            FusedKFModule(
+                BizcateCorrelationKFModule,
+                metric_cols=metric_cols,
+                output_col_suffix="_CORR",
+                diagonal_measurement=True,
+                corr_matrix_path=corr_matrix_path,
+                **kwargs,
+            ),
+        ]
+
+    def output_cols(self, metric_col):
+        return [
+            f"{metric_col}{suffix}_{output}"
+            for suffix in ("_NO_CORR", "_CORR")
+            for output in self.outputs
+        ]
+
+    def dataloader(self, table):
+        return DataLoader(
+            table=table,
+            id_cols=self.id_cols,
+            date_col=self.date_col,
+            var_cols=self.var_cols,
+        )
+
+
+# %%
+# stages, each a plain function of the spec and upstream results
+
+
+def filter_stage(
+    spec, table, metric_cols, executor=None, batch_over=None, **runner_options
+):
+    """runner_options: state_dir, incremental, checkpoint of the BatchedRunner"""
+
+    runner = BatchedRunner(
+        callbacks=spec.callbacks,
+        outputs=spec.outputs,
+        smoother_lag=spec.smoother_lag,
+        resmooth_window=spec.resmooth_window,
+        executor=executor,
+        batch_over=batch_over,
+        **runner_options,
+    )
+    return runner.run(
+        models=spec.models(metric_cols),
+        dataloaders=spec.dataloader(table),
+        parallel=executor is not None,
+    )
+
+
+def national_table(spec, raw):
+    return raw[raw[spec.cut_col] == spec.national_cut_id]
+
+
+def align_to_national(national, regional, on):
+    """
+    Row position in national of every regional row, matching on `on`, -1 if none.
+
+    national has to be unique on `on`, i.e. a single cut.
+    """
+
+    # one int64 key per row from the national codes of each column in mixed radix,
+    # missing regional values get digit 0 and never match, NaN keys match nothing
+    national_key = np.zeros(len(national), dtype=np.int64)
+    regional_key = np.zeros(len(regional), dtype=np.int64)
+    national_missing = np.zeros(len(national), dtype=bool)
+    n_keys = 1
+    for col in on:
+        codes, uniques = pd.factorize(national[col])
+        radix = len(uniques) + 1
+        n_keys *= radix
+        if n_keys > np.iinfo(np.int64).max:
+            raise OverflowError(f"{on} have too many distinct values for an int64 key")
+        national_missing |= codes < 0
+        national_key = national_key * radix + codes + 1
+        regional_key = (
+            regional_key * radix + pd.Index(uniques).get_indexer(regional[col]) + 1
+        )
+
+    # NaN national keys are -1 codes (digit 0 like a missing regional value), so
+    # they are dropped instead of matching those
+    national_key[national_missing] = -1 - np.arange(national_missing.sum())
+    national_index = pd.Index(national_key)
+    if not national_index.is_unique:
+        raise ValueError(f"national rows are not unique on {on}")
+    return national_index.get_indexer(regional_key)
+
+
+def subtract_from_national(
+    national, regional, on, national_cols, regional_cols, output_cols, drop_cols=()
+):
+    """
+    Regional rows with a national row (as an inner join on `on` would keep), with
+    output_cols = national[national_cols] - regional[regional_cols].
+
+    Rows are aligned by position and the subtraction is a single block operation
+    over all columns, instead of joining on the key columns and subtracting one
+    column at a time.
+    """
+
+    positions = align_to_national(national, regional, on)
+    matched = positions >= 0
+
+    values = (
+        national[national_cols].to_numpy(dtype=float)[positions[matched]]
+        - regional[regional_cols].to_numpy(dtype=float)[matched]
+    )
+
+    keep_cols = [
+        col for col in regional.columns if col not in set(drop_cols) | set(output_cols)
+    ]
+    return pd.concat(
+        [
+            regional.loc[matched, keep_cols].reset_index(drop=True),
+            pd.DataFrame(values, columns=output_cols),
+        ],
+        axis=1,
+    )
+
+
+def delta_table(spec, raw):
+    """Demo cut rows with <metric>_DELTA = national - demo"""
+
+    return subtract_from_national(
+        national=national_table(spec, raw),
+        regional=raw[raw[spec.cut_col] != spec.national_cut_id],
+        on=spec.join_cols,
+        national_cols=spec.metric_cols,
+        regional_cols=spec.metric_cols,
+        output_cols=[f"{col}_DELTA" for col in spec.metric_cols],
+    )
+
+
+def recombine_stage(spec, national_filtered, delta_filtered):
+    """Demo cut outputs as filtered national - filtered delta"""
+
+    output_cols, delta_output_cols = [], []
+    for metric_col in spec.metric_cols:
+        for col in spec.output_cols(metric_col):
+            output_cols.append(col)
+            delta_output_cols.append(col.replace(metric_col, f"{metric_col}_DELTA", 1))
+
+    return subtract_from_national(
+        national=national_filtered,
+        regional=delta_filtered,
+        on=spec.join_cols,
+        national_cols=output_cols,
+        regional_cols=delta_output_cols,
+        output_cols=output_cols,
+        drop_cols=[f"{col}_DELTA" for col in spec.metric_cols] + delta_output_cols,
+    )
+
+
+def finalize_stage(spec, national_filtered, demo_filtered):
+    filtered = pd.concat([national_filtered, demo_filtered], ignore_index=True)
+    output_cols = [
+        col for metric_col in spec.metric_cols for col in spec.output_cols(metric_col)
+    ]
+
+    if spec.clip_lower is not None:
+        filtered[output_cols] = filtered[output_cols].clip(lower=spec.clip_lower)
+
+    if spec.logit_transform:
+        for col in spec.metric_cols + output_cols:
+            filtered[col] = inv_logit(filtered[col])
+
+    # ids come back from the runner at full width, compact again for the upload
+    return compact(filtered, float32=spec.float32, name=spec.name)
+
+
+def upload_stage(spec, filtered, uploads, since=None, mode="replace"):
+    """Queue a replace (or upsert) of filtered into FUSEDDATA.DATASCI_LAB"""
+
+    data = filtered
+    if spec.upload_date_col != spec.date_col:
+        data = with_month_year(filtered, spec.date_col, spec.upload_date_col)
+
+    if mode == "replace":
+        uploads.submit(
+            data,
+            table=spec.upload_table,
+            database="FUSEDDATA",
+            schema="DATASCI_LAB",
+            replace=True,
+        )
+        return filtered
+
+    uploads.submit(
+        data,
+        table=spec.upload_table,
+        key_cols=spec.id_cols + [spec.upload_date_col] + spec.var_cols,
+        database="FUSEDDATA",
+        schema="DATASCI_LAB",
+        since=since,
+        date_col=spec.upload_date_col,
+    )
+    return filtered
+
+
+# %%
+def run_dag(nodes, executor):
+    """
+    Run {name: (fn, deps)} on executor, each node once all its deps are done.
+
+    fn gets the results of deps as positional arguments. Results are dropped once
+    every dependent node has started, only leaf results are returned.
+    """
+
+    missing = {dep for _, deps in nodes.values() for dep in deps} - set(nodes)
+    if missing:
+        raise KeyError(f"unknown dependencies {sorted(missing)}")
+
+    n_dependents = {name: 0 for name in nodes}
+    for _, deps in nodes.values():
+        for dep in deps:
+            n_dependents[dep] += 1
+
+    pending = dict(nodes)
+    results, running = {}, {}
+    while pending or running:
+        for name, (fn, deps) in list(pending.items()):
+            if all(dep in results for dep in deps):
+                running[executor.submit(fn, *[results[dep] for dep in deps])] = name
+                del pending[name]
+                for dep in deps:
+                    n_dependents[dep] -= 1
+                    if n_dependents[dep] == 0:
+                        del results[dep]
+
+        if not running:
+            raise RuntimeError(f"cycle between {sorted(pending)}")
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[running.pop(future)] = future.result()
+
+    return results
+
+
+class Pipeline:
+    """
+    One execution DAG for a list of MetricSpecs.
+
+    Per spec: load -> (national filter | delta -> delta filter) -> recombine ->
+    finalize -> upload. Identical sources are loaded once, the national and delta
+    filters of every spec share one process pool, and warehouse reads and uploads
+    of one spec overlap with filtering of the others.
+
+    Uploads rewrite whole tables (upload.replace_table), the way the model scripts
+    uploaded, through upload_backend, a SnowflakeBackend by default or a
+    LocalBackend for offline runs. upload_mode="upsert" only merges the rows that
+    changed (upload.upsert) and needs SnowflakeBackend(engine) for Snowflake.
+    upload_since (only uploading months from then on) and incremental runs need
+    upsert uploads. Uploads run in the background, at most max_uploads at a time,
+    while the DAG moves on. run waits for them at the end, keeps their records in
+    upload_report and raises if any failed.
+
+    Warehouse reads go through the collect cache (cache.cached_collect), so a rerun
+    within CACHE_TTL reuses them. refresh_cache=True reads everything from the
+    warehouse again, once per run, and caches the new results.
+
+    The filters of every spec get their own subdirectory (<spec name>/national,
+    <spec name>/delta) of:
+    - state_dir: filter states are persisted there, and incremental=True only
+      filters the months after them (BatchedRunner incremental runs), which
+      specs with callbacks that fit on the data (Scaler) can't take part in
+    - checkpoint_dir: finished batches are checkpointed there, and a rerun after
+      a crash only filters the partitions that were not finished (Checkpoint)
+    """
+
+    def __init__(
+        self,
+        specs,
+        n_jobs=None,
+        max_threads=8,
+        upload=True,
+        upload_backend=None,
+        upload_since=None,
+        upload_mode="replace",
+        max_uploads=2,
+        refresh_cache=False,
+        state_dir=None,
+        incremental=False,
+        checkpoint_dir=None,
+    ):
+        names = [spec.name for spec in specs]
+        if len(set(names)) != len(names):
+            raise ValueError(f"duplicate spec names in {names}")
+        if incremental and state_dir is None:
+            raise ValueError("incremental runs need a state_dir")
+        fitting = [spec.name for spec in specs if spec.fits_on_data]
+        if incremental and fitting:
+            raise ValueError(
+                "incremental runs can't use callbacks that fit on the data, "
+                f"leave out {fitting}"
+            )
+        if upload_mode not in ("upsert", "replace"):
+            raise ValueError(
+                f"unknown upload_mode {upload_mode!r}, expected 'upsert' or 'replace'"
+            )
+        if (
+            upload
+            and upload_mode == "replace"
+            and (upload_since is not None or incremental)
+        ):
+            raise ValueError(
+                "replace uploads would drop the months this run leaves out"
+            )
+        if upload and upload_mode == "upsert" and upload_backend is None:
+            raise ValueError("upsert uploads need SnowflakeBackend(engine)")
+
+        self.specs = specs
+        self.n_jobs = n_jobs
+        self.max_threads = max_threads
+        self.upload = upload
+        self.upload_backend = upload_backend or SnowflakeBackend()
+        self.upload_since = upload_since
+        self.upload_mode = upload_mode
+        self.max_uploads = max_uploads
+        self.refresh_cache = refresh_cache
+        self.state_dir = Path(state_dir) if state_dir is not None else None
+        self.incremental = incremental
+        self.checkpoint_dir = (
+            Path(checkpoint_dir) if checkpoint_dir is not None else None
+        )
+        self.upload_report = []
+
+    def runner_options(self, spec, stage):
+        """BatchedRunner state_dir, incremental, checkpoint of a filter stage"""
+
+        options = {}
+        if self.state_dir is not None:
+            options["state_dir"] = self.state_dir / spec.name / stage
+            options["incremental"] = self.incremental
+        if self.checkpoint_dir is not None:
+            options["checkpoint"] = Checkpoint(self.checkpoint_dir / spec.name / stage)
+        return options
+
+    def plan(self, executor=None, uploads=None):
+        nodes = {}
+        for spec in self.specs:
+            load = f"load:{spec.source.key}"
+            nodes[load] = (spec.source.load, [])
+
+            delta_cols = [f"{col}_DELTA" for col in spec.metric_cols]
+            nodes[f"{spec.name}:national"] = (
+                lambda raw, spec=spec: filter_stage(
+                    spec,
+                    national_table(spec, raw),
+                    spec.metric_cols,
+                    executor,
+                    **self.runner_options(spec, "national"),
+                ),
+                [load],
+            )
+            # all demo cuts of a retailer/channel are filtered as one batch
+            nodes[f"{spec.name}:delta"] = (
+                lambda raw, spec=spec, delta_cols=delta_cols: filter_stage(
+                    spec,
+                    delta_table(spec, raw),
+                    delta_cols,
+                    executor,
+                    batch_over=[spec.cut_col],
+                    **self.runner_options(spec, "delta"),
+                ),
+                [load],
+            )
+            nodes[f"{spec.name}:recombine"] = (
+                lambda national, delta, spec=spec: (
+                    national,
+                    recombine_stage(spec, national, delta),
+                ),
+                [f"{spec.name}:national", f"{spec.name}:delta"],
+            )
+            nodes[f"{spec.name}:finalize"] = (
+                lambda parts, spec=spec: finalize_stage(spec, *parts),
+                [f"{spec.name}:recombine"],
+            )
+            if uploads is not None and spec.upload_table is not None:
+                nodes[f"{spec.name}:upload"] = (
+                    lambda filtered, spec=spec: upload_stage(
+                        spec, filtered, uploads, self.upload_since, self.upload_mode
+                    ),
+                    [f"{spec.name}:finalize"],
+                )
+        return nodes
+
+    def run(self):
+        """Run every spec, returning {spec name: filtered output}"""
+
+        if self.refresh_cache:
+            invalidate_cache()
+            # tables already read by this process are read again too
+            month_lookup.cache_clear()
+            shared_bizcat_corr_matrix.cache_clear()
+
+        uploads = (
+            UploadQueue(self.upload_backend, max_workers=self.max_uploads)
+            if self.upload
+            else None
+        )
+        try:
+            with ProcessPoolExecutor(max_workers=self.n_jobs) as processes:
+                with ThreadPoolExecutor(max_workers=self.max_threads) as threads:
+                    results = run_dag(self.plan(processes, uploads), threads)
+        finally:
+            # uploads already queued are finished (and reported) even if a stage failed
+            self.upload_report = uploads.wait() if uploads is not None else []
+
+        for record in self.upload_report:
+            print(f"{record['table']}: {record['status']} in {record['seconds']:.1f}s")
+        failed = [
+            record["table"]
+            for record in self.upload_report
+            if record["status"] == "failed"
+        ]
+        if failed:
+            raise RuntimeError(f"uploads failed for {failed}, see upload_report")
+
+        return {name.rsplit(":", 1)[0]: result for name, result in results.items()}
@@ -0,0 +1,34 @@
+# %%
+from pipeline import Pipeline, CHECKPOINT_DIR, STATE_DIR
+from metrics import SPECS
+
+
+# %% filter and upload every model table in one run
+# refresh_cache: read the warehouse again instead of collect cache entries from
+# the last CACHE_TTL, which is only meant for reruns
+# checkpoint_dir: rerunning this cell after a crash (e.g. partway through a050)
+# only filters the partitions that were not finished
+pipeline = Pipeline(
+    SPECS, refresh_cache=True, checkpoint_dir=CHECKPOINT_DIR, state_dir=STATE_DIR
+)
+filtered = pipeline.run()
+
+# %% or a monthly update from the filter states persisted by the last run,
+# leaving out the Scaler specs, which refit on the data and need full runs.
+# Only the new months are filtered, so they are upserted (engine: a SQLAlchemy
+# engine on the warehouse)
+# from upload import SnowflakeBackend
+# filtered = Pipeline(
+#     [spec for spec in SPECS if not spec.fits_on_data],
+#     refresh_cache=True,
+#     checkpoint_dir=CHECKPOINT_DIR,
+#     state_dir=STATE_DIR,
+#     incremental=True,
+#     upload_mode="upsert",
+#     upload_backend=SnowflakeBackend(engine),
+# ).run()
+
+# %% or a subset, without uploading
+# filtered = Pipeline(
+#     [spec for spec in SPECS if spec.name.startswith("a050")], upload=False
+# ).run()
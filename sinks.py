@@ -0,0 +1,68 @@
+# %%
+import uuid
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+# %%
+class ParquetSink:
+    """
+    Appends finished long batches of a BatchedRunner run to a hive partitioned
+    Parquet dataset on local disk (e.g. CUT_ID=1/CHANNEL=BM/...parquet).
+
+    Only partition_cols present in the output are used. A run refuses to start on
+    a non-empty path unless overwrite=True, in which case the Parquet files a
+    previous run left there are removed first. dataset() is the lazy handle run
+    returns; read() loads it as a DataFrame.
+    """
+
+    def __init__(self, path, partition_cols=("CUT_ID", "CHANNEL"), overwrite=False):
+        self.path = Path(path)
+        self.partition_cols = list(partition_cols)
+        self.overwrite = overwrite
+        self._run_id = None
+        self._n_written = 0
+        self._schema = None
+
+    def open(self):
+        if self.path.exists() and any(self.path.iterdir()):
+            if not self.overwrite:
+                raise FileExistsError(
+                    f"{self.path} is not empty, pass overwrite=True to replace its Parquet files"
+                )
+            self._remove_previous_run()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._run_id = uuid.uuid4().hex
+        self._n_written = 0
+        self._schema = None
+
+    def _remove_previous_run(self):
+        # only hive partition dirs and the Parquet files in them, anything else is kept
+        for file in self.path.glob("**/*.parquet"):
+            file.unlink()
+        for directory in sorted(self.path.glob("**/*=*"), reverse=True):
+            if directory.is_dir() and not any(directory.iterdir()):
+                directory.rmdir()
+
+    def write(self, df):
+        partition_cols = [col for col in self.partition_cols if col in df.columns]
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # keeps column order and partition col types when reading back
+        self._schema = self._schema or table.schema.remove_metadata()
+        pq.write_to_dataset(
+            table,
+            root_path=self.path,
+            partition_cols=partition_cols or None,
+            basename_template=f"{self._run_id}-{self._n_written}-{{i}}.parquet",
+        )
+        self._n_written += 1
+
+    def dataset(self):
+        return ds.dataset(
+            self.path, schema=self._schema, format="parquet", partitioning="hive"
+        )
+
+    def read(self, columns=None, filter=None):
+        return self.dataset().to_table(columns=columns, filter=filter).to_pandas()
@@ -0,0 +1,387 @@
+"""
+Regression tests for kf_engine.
+
+Run with pytest from the repo root. The module needs fusion_kf and filterpy
+(a dev dependency) and is skipped without them.
+"""
+
+# %%
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("fusion_kf")
+pytest.importorskip("filterpy")
+
+from filterpy.kalman import KalmanFilter
+from fusion_kf import DataLoader, Runner
+from fusion_kf.callbacks import ConcactPartitions, PivotLong
+from fusion_kf.kf_modules import NoCorrelationKFModule
+
+import kf_modules
+from kf_engine import (
+    BatchedRunner,
+    Checkpoint,
+    filter_partition,
+    fixed_lag_smoother,
+    kalman_filter,
+    rts_smoother,
+)
+from kf_modules import BizcateCorrelationKFModule, FusedKFModule
+from callbacks import Scaler
+from sklearn.preprocessing import PowerTransformer
+
+
+# %% fixtures
+BIZCATES = [101, 104, 107, 110]
+KEYS = ["CUT_ID", "RETAILER_CODE", "MONTH_YEAR", "BIZCATE_CODE"]
+
+
+def fixture_corr_matrix():
+    rng = np.random.default_rng(0)
+    A = rng.uniform(0, 1, (len(BIZCATES), len(BIZCATES)))
+    codes = pd.Index(BIZCATES, name="BIZCATE_CODE")
+    return pd.DataFrame(
+        np.corrcoef(A) ** 2,
+        index=codes,
+        columns=codes.rename("SIMILAR_BIZCATE_CODE"),
+    )
+
+
+def fixture_panel():
+    """Logit-space long table: 2 cuts x 4 retailers x 18 months, some with 2 bizcates"""
+
+    rng = np.random.default_rng(1)
+    rows = []
+    for cut in [1, 2]:
+        for retailer in range(4):
+            bizcates = BIZCATES if retailer % 2 else BIZCATES[:2]
+            for month in pd.date_range("2021-01-01", periods=18, freq="MS"):
+                for bizcate in bizcates:
+                    rows.append(
+                        (
+                            cut,
+                            retailer,
+                            month,
+                            bizcate,
+                            rng.uniform(0.05, 0.95),
+                            rng.integers(5, 200),
+                        )
+                    )
+    table = pd.DataFrame(rows, columns=KEYS + ["TOM", "ASK_COUNT"])
+    table["TOM"] = np.log(table["TOM"] / (1 - table["TOM"]))
+    return table
+
+
+def filterpy_reference(zs, Q, Rs):
+    """
+    Filtered and RTS smoothed means of one partition with filterpy, started from
+    the first measurement like kalman_filter.
+    """
+
+    T, B = zs.shape
+    kf = KalmanFilter(dim_x=B, dim_z=B)
+    kf.F, kf.H, kf.Q = np.eye(B), np.eye(B), Q
+    kf.x, kf.P = zs[0].copy(), Rs[0].copy()
+
+    xs, Ps = [kf.x.copy()], [kf.P.copy()]
+    for t in range(1, T):
+        kf.predict()
+        kf.update(zs[t], R=Rs[t])
+        xs.append(kf.x.copy())
+        Ps.append(kf.P.copy())
+    xs, Ps = np.array(xs), np.array(Ps)
+    xs_s, Ps_s, _, _ = kf.rts_smoother(xs, Ps)
+    return xs, Ps, xs_s, Ps_s
+
+
+class FixtureCorrMatrixMixin:
+    def setUp(self):
+        # keep the fixture matrix in memory instead of a shared .npy file
+        env = mock.patch.dict(os.environ)
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop("BIZCATE_CORR_MATRIX_NPY", None)
+
+        patcher = mock.patch.object(
+            kf_modules, "full_bizcat_corr_matrix", fixture_corr_matrix
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        kf_modules.shared_bizcat_corr_matrix.cache_clear()
+        kf_modules._process_cov_cache.clear()
+        self.addCleanup(kf_modules.shared_bizcat_corr_matrix.cache_clear)
+        self.addCleanup(kf_modules._process_cov_cache.clear)
+
+    def corr_module(self, **kwargs):
+        return BizcateCorrelationKFModule(
+            metric_col="TOM",
+            output_col_prefix="TOM_CORR",
+            sample_size_col="ASK_COUNT",
+            process_std=0.02,
+            **kwargs,
+        )
+
+
+class LoaderStub:
+    def __init__(self, table):
+        self.table = table
+        self.id_cols = ["CUT_ID", "RETAILER_CODE"]
+        self.date_col = "MONTH_YEAR"
+        self.var_cols = ["BIZCATE_CODE"]
+
+
+def sort_long(df):
+    return df.sort_values(KEYS).reset_index(drop=True)
+
+
+# %% filter and smoother
+class KalmanFilterTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.T, self.B = 15, 4
+        self.zs = rng.normal(size=(3, self.T, self.B))
+        A = rng.normal(size=(self.B, self.B))
+        self.Q = A @ A.T * 1e-3
+        self.rs = rng.uniform(1e-3, 1e-1, size=(3, self.T, self.B))
+
+    def test_dense_matches_filterpy(self):
+        Rs = self.rs[..., np.newaxis] * np.eye(self.B)
+        xs, Ps = kalman_filter(self.zs, self.Q, Rs)
+        xs_s = rts_smoother(xs, Ps, self.Q)
+        for p in range(len(self.zs)):
+            ref_xs, ref_Ps, ref_xs_s, _ = filterpy_reference(self.zs[p], self.Q, Rs[p])
+            np.testing.assert_allclose(xs[p], ref_xs, rtol=1e-9, atol=1e-12)
+            np.testing.assert_allclose(Ps[p], ref_Ps, rtol=1e-9, atol=1e-12)
+            np.testing.assert_allclose(xs_s[p], ref_xs_s, rtol=1e-9, atol=1e-12)
+
+    def test_diagonal_r_matches_dense_r(self):
+        dense = kalman_filter(
+            self.zs, self.Q, self.rs[..., np.newaxis] * np.eye(self.B)
+        )
+        diagonal = kalman_filter(self.zs, self.Q, self.rs)
+        for a, b in zip(dense, diagonal):
+            np.testing.assert_allclose(a, b, rtol=1e-10, atol=1e-14)
+
+    def test_elementwise_matches_filterpy(self):
+        Q = np.diag(np.diag(self.Q))
+        xs, Ps = kalman_filter(self.zs, Q, self.rs)
+        self.assertEqual(Ps.ndim, 3)
+        xs_s = rts_smoother(xs, Ps, Q)
+        for p in range(len(self.zs)):
+            Rs = self.rs[p][..., np.newaxis] * np.eye(self.B)
+            ref_xs, ref_Ps, ref_xs_s, _ = filterpy_reference(self.zs[p], Q, Rs)
+            np.testing.assert_allclose(xs[p], ref_xs, rtol=1e-9, atol=1e-12)
+            np.testing.assert_allclose(
+                Ps[p], np.diagonal(ref_Ps, axis1=-2, axis2=-1), rtol=1e-9, atol=1e-12
+            )
+            np.testing.assert_allclose(xs_s[p], ref_xs_s, rtol=1e-9, atol=1e-12)
+
+    def test_smoothed_covariances_match_filterpy(self):
+        Rs = self.rs[..., np.newaxis] * np.eye(self.B)
+        xs, Ps = kalman_filter(self.zs, self.Q, Rs)
+        xs_s, Ps_s = rts_smoother(xs, Ps, self.Q, return_cov=True)
+        np.testing.assert_array_equal(xs_s, rts_smoother(xs, Ps, self.Q))
+        _, _, _, ref_Ps_s = filterpy_reference(self.zs[0], self.Q, Rs[0])
+        np.testing.assert_allclose(Ps_s[0], ref_Ps_s, rtol=1e-9, atol=1e-12)
+
+    def test_resume_from_prior_matches_full_run(self):
+        xs, Ps = kalman_filter(self.zs, self.Q, self.rs)
+        W = 6
+        xs_resumed, Ps_resumed = kalman_filter(
+            self.zs[:, W:], self.Q, self.rs[:, W:], x0=xs[:, W - 1], P0=Ps[:, W - 1]
+        )
+        np.testing.assert_allclose(xs_resumed, xs[:, W:], rtol=1e-12)
+        np.testing.assert_allclose(Ps_resumed, Ps[:, W:], rtol=1e-12)
+
+    def test_fixed_lag_smoother(self):
+        xs, Ps = kalman_filter(self.zs, self.Q, self.rs)
+        np.testing.assert_array_equal(
+            fixed_lag_smoother(xs, Ps, self.Q, self.T), rts_smoother(xs, Ps, self.Q)
+        )
+
+        lag = 3
+        smoothed = fixed_lag_smoother(xs, Ps, self.Q, lag)
+        for t in range(self.T):
+            end = min(t + lag, self.T - 1) + 1
+            window = rts_smoother(xs[:, :end], Ps[:, :end], self.Q)
+            np.testing.assert_allclose(smoothed[:, t], window[:, t], rtol=1e-10)
+
+
+# %% runner
+class BatchedRunnerTest(FixtureCorrMatrixMixin, unittest.TestCase):
+    def test_batches_match_partition_by_partition(self):
+        table = fixture_panel()
+        module = self.corr_module(diagonal_measurement=True)
+        output = sort_long(
+            BatchedRunner().run(models=[module], dataloaders=LoaderStub(table))
+        )
+
+        for (cut, retailer), long_partition in table.groupby(
+            ["CUT_ID", "RETAILER_CODE"]
+        ):
+            wide = long_partition.set_index(KEYS).unstack("BIZCATE_CODE")
+            expected = filter_partition(module, wide)
+            rows = output[(output.CUT_ID == cut) & (output.RETAILER_CODE == retailer)]
+            for col in ["TOM_CORR_KF", "TOM_CORR_RTS"]:
+                np.testing.assert_allclose(
+                    rows[col].to_numpy(),
+                    expected[col].stack().sort_index().to_numpy(),
+                    rtol=1e-12,
+                )
+
+    def test_fused_module_matches_single_modules(self):
+        table = fixture_panel().assign(TOTALTHINK=lambda df: df.TOM / 2)
+        kwargs = dict(sample_size_col="ASK_COUNT", process_std=0.02)
+        fused = FusedKFModule(
+            BizcateCorrelationKFModule,
+            metric_cols=["TOM", "TOTALTHINK"],
+            output_col_suffix="_CORR",
+            **kwargs,
+        )
+        singles = [
+            BizcateCorrelationKFModule(
+                metric_col=col, output_col_prefix=f"{col}_CORR", **kwargs
+            )
+            for col in ["TOM", "TOTALTHINK"]
+        ]
+        a = sort_long(
+            BatchedRunner().run(models=[fused], dataloaders=LoaderStub(table))
+        )
+        b = sort_long(
+            BatchedRunner().run(models=singles, dataloaders=LoaderStub(table))
+        )
+        pd.testing.assert_frame_equal(a, b[a.columns], rtol=1e-12)
+
+    def test_process_covariance_follows_a_reloaded_matrix(self):
+        wide = fixture_panel().set_index(KEYS)[["TOM"]].unstack("BIZCATE_CODE")
+        before = self.corr_module().process_covariance(wide)
+
+        kf_modules.shared_bizcat_corr_matrix.cache_clear()
+        with mock.patch.object(
+            kf_modules,
+            "full_bizcat_corr_matrix",
+            lambda: fixture_corr_matrix() / 2,
+        ):
+            after = self.corr_module().process_covariance(wide)
+        np.testing.assert_allclose(after, before / 2)
+
+    def test_batch_over_matches_separate_batches(self):
+        table = fixture_panel()
+        module = self.corr_module(diagonal_measurement=True)
+        a = sort_long(
+            BatchedRunner().run(models=[module], dataloaders=LoaderStub(table))
+        )
+        b = sort_long(
+            BatchedRunner(batch_over=["CUT_ID"]).run(
+                models=[module], dataloaders=LoaderStub(table)
+            )
+        )
+        pd.testing.assert_frame_equal(a, b, rtol=1e-8)
+
+    def test_empty_input_returns_empty_output_with_the_same_columns(self):
+        table = fixture_panel()
+        module = self.corr_module(diagonal_measurement=True)
+        full = BatchedRunner().run(models=[module], dataloaders=LoaderStub(table))
+        empty = BatchedRunner(batch_over=["CUT_ID"]).run(
+            models=[module], dataloaders=LoaderStub(table.iloc[:0])
+        )
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(list(empty.columns), list(full.columns))
+
+    def test_checkpoint_rerun_returns_the_same_output(self):
+        table = fixture_panel()
+        module = self.corr_module(diagonal_measurement=True)
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpoint = Checkpoint(checkpoint_dir, clear_on_success=False)
+            first = BatchedRunner(checkpoint=checkpoint).run(
+                models=[module], dataloaders=LoaderStub(table)
+            )
+            with mock.patch(
+                "kf_engine.filter_batch", side_effect=AssertionError("refiltered")
+            ):
+                rerun = BatchedRunner(checkpoint=checkpoint).run(
+                    models=[module], dataloaders=LoaderStub(table)
+                )
+        pd.testing.assert_frame_equal(sort_long(first), sort_long(rerun))
+
+    def test_checkpoint_is_not_shared_across_callback_params(self):
+        table = fixture_panel()
+        module = self.corr_module(diagonal_measurement=True)
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpoint = Checkpoint(checkpoint_dir, clear_on_success=False)
+            BatchedRunner(callbacks=[Scaler()], checkpoint=checkpoint).run(
+                models=[module], dataloaders=LoaderStub(table)
+            )
+            with mock.patch(
+                "kf_engine.filter_batch", side_effect=AssertionError("refiltered")
+            ):
+                with self.assertRaisesRegex(AssertionError, "refiltered"):
+                    BatchedRunner(
+                        callbacks=[Scaler(PowerTransformer)], checkpoint=checkpoint
+                    ).run(models=[module], dataloaders=LoaderStub(table))
+
+    def test_incremental_refuses_callbacks_that_fit_on_the_data(self):
+        with tempfile.TemporaryDirectory() as state_dir:
+            with self.assertRaisesRegex(ValueError, "Scaler"):
+                BatchedRunner(
+                    callbacks=[Scaler()], state_dir=state_dir, incremental=True
+                )
+
+
+# %% fusion_kf parity
+class FusionKFParityTest(FixtureCorrMatrixMixin, unittest.TestCase):
+    """
+    BatchedRunner has to give the published numbers, i.e. what fusion_kf's Runner
+    gives on the same panel, first months included.
+    """
+
+    def test_matches_fusion_kf_runner(self):
+        table = fixture_panel()
+        models = [
+            NoCorrelationKFModule(
+                metric_col="TOM",
+                output_col_prefix="TOM_NO_CORR",
+                sample_size_col="ASK_COUNT",
+                process_std=0.02,
+            ),
+            self.corr_module(),
+        ]
+        dataloader = DataLoader(
+            table=table,
+            id_cols=["CUT_ID", "RETAILER_CODE"],
+            date_col="MONTH_YEAR",
+            var_cols=["BIZCATE_CODE"],
+        )
+
+        expected = Runner(callbacks=[PivotLong(), ConcactPartitions()]).run(
+            models=models, dataloaders=dataloader
+        )
+        actual = BatchedRunner().run(models=models, dataloaders=dataloader)
+
+        output_cols = [
+            f"{prefix}_{output}"
+            for prefix in ["TOM_NO_CORR", "TOM_CORR"]
+            for output in ["KF", "RTS"]
+        ]
+        merged = sort_long(expected[KEYS + output_cols]).merge(
+            sort_long(actual[KEYS + output_cols]), on=KEYS, suffixes=("_FUSION_KF", "")
+        )
+        self.assertEqual(len(merged), len(table))
+        for col in output_cols:
+            np.testing.assert_allclose(
+                merged[col],
+                merged[f"{col}_FUSION_KF"],
+                rtol=1e-8,
+                atol=1e-10,
+                err_msg=col,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
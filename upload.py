@@ -0,0 +1,417 @@
+# %%
+import os
+import uuid
+import time
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+# %%
+UPLOAD_CHUNK_ROWS = int(os.getenv("BIZCATE_UPLOAD_CHUNK_ROWS", 500_000))
+
+
+# %%
+def _columns(data):
+    return list(data.columns) if isinstance(data, pd.DataFrame) else data.schema.names
+
+
+def _since(since, is_date):
+    # date columns (e.g. MONTH_YEAR from db.month_lookup) compare with dates
+    since = pd.Timestamp(since)
+    return since.date() if is_date else since
+
+
+def write_chunks(
+    data, directory, chunk_rows=UPLOAD_CHUNK_ROWS, since=None, date_col="MONTH_YEAR"
+):
+    """
+    Write a DataFrame or pyarrow dataset (e.g. ParquetSink.dataset()) as zstd
+    Parquet files of at most chunk_rows rows, returns their paths.
+    """
+
+    # warehouses load microsecond timestamps, pandas writes nanoseconds
+    options = dict(
+        compression="zstd", coerce_timestamps="us", allow_truncated_timestamps=True
+    )
+
+    if isinstance(data, pd.DataFrame):
+        if since is not None:
+            # NaT (months missing from the mapping) never passes
+            data = data[pd.to_datetime(data[date_col]) >= pd.Timestamp(since)]
+        tables = (
+            pa.Table.from_pandas(
+                data.iloc[start : start + chunk_rows], preserve_index=False
+            )
+            for start in range(0, max(len(data), 1), chunk_rows)
+        )
+    else:
+        # datasets are streamed batch by batch and never loaded as a whole
+        is_date = pa.types.is_date(data.schema.field(date_col).type)
+        batches = data.to_batches(
+            batch_size=chunk_rows,
+            filter=ds.field(date_col) >= _since(since, is_date)
+            if since is not None
+            else None,
+        )
+        tables = (pa.Table.from_batches([batch]) for batch in batches)
+
+    paths = []
+    for i, table in enumerate(tables):
+        path = Path(directory) / f"part-{i:05d}.parquet"
+        pq.write_table(table, path, **options)
+        paths.append(path)
+    return paths
+
+
+def upsert(
+    data,
+    table,
+    key_cols,
+    backend,
+    database="FUSEDDATA",
+    schema="DATASCI_LAB",
+    since=None,
+    date_col="MONTH_YEAR",
+    chunk_rows=UPLOAD_CHUNK_ROWS,
+):
+    """
+    Upload data (a DataFrame or pyarrow dataset) into database.schema.table, only
+    touching rows that changed.
+
+    data is written as compressed Parquet chunks, staged and bulk loaded by backend,
+    then merged on key_cols: new keys are inserted, existing keys are updated when
+    any value differs, everything else (including rows missing from data) is left
+    as is. A missing table is created from data.
+
+    since: only rows with date_col >= since are uploaded, for runs where older
+        months cannot have changed (e.g. with a fixed-lag smoother).
+
+    Returns {"inserted": n, "updated": n, "unchanged": n}.
+    """
+
+    cols = _columns(data)
+    missing = [col for col in key_cols if col not in cols]
+    if missing:
+        raise KeyError(f"key columns {missing} are not in the upload")
+
+    with tempfile.TemporaryDirectory(prefix="bizcate_upload_") as tmp_dir:
+        paths = write_chunks(
+            data, tmp_dir, chunk_rows=chunk_rows, since=since, date_col=date_col
+        )
+        stage = backend.stage(paths, database, schema)
+        try:
+            if not backend.exists(database, schema, table):
+                backend.create(stage, database, schema, table)
+                n_rows = sum(pq.ParquetFile(path).metadata.num_rows for path in paths)
+                return {"inserted": n_rows, "updated": 0, "unchanged": 0}
+            return backend.merge(stage, database, schema, table, list(key_cols), cols)
+        finally:
+            backend.drop_stage(stage)
+
+
+def replace_table(data, table, backend, database="FUSEDDATA", schema="DATASCI_LAB"):
+    """
+    Replace database.schema.table with data (a DataFrame or pyarrow dataset), the
+    full rewrite the model scripts did before upsert.
+
+    Returns {"replaced": n}.
+    """
+
+    df = data if isinstance(data, pd.DataFrame) else data.to_table().to_pandas()
+    backend.replace(_decategorize(df), database, schema, table)
+    return {"replaced": len(df)}
+
+
+def _check_columns(table_cols, cols, target):
+    missing = [col for col in table_cols if col not in cols]
+    extra = [col for col in cols if col not in table_cols]
+    if missing or extra:
+        raise ValueError(
+            f"upload columns differ from {target}: "
+            f"missing {missing}, not in the table {extra}"
+        )
+
+
+def _decategorize(df):
+    categorical = [
+        col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)
+    ]
+    return df.astype({col: object for col in categorical}) if categorical else df
+
+
+# %%
+class LocalBackend:
+    """
+    Stand-in warehouse keeping every table as one Parquet file under
+    root/DATABASE/SCHEMA/TABLE.parquet, for tests and offline runs.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _path(self, database, schema, table):
+        return self.root / database / schema / f"{table}.parquet"
+
+    def read(self, database, schema, table):
+        return pd.read_parquet(self._path(database, schema, table))
+
+    def exists(self, database, schema, table):
+        return self._path(database, schema, table).exists()
+
+    def stage(self, paths, database, schema):
+        stage = self.root / "_stages" / uuid.uuid4().hex
+        stage.mkdir(parents=True)
+        for path in paths:
+            shutil.copy(path, stage / Path(path).name)
+        return stage
+
+    def drop_stage(self, stage):
+        shutil.rmtree(stage, ignore_errors=True)
+
+    def _load(self, stage):
+        return pq.read_table(sorted(Path(stage).glob("*.parquet"))).to_pandas()
+
+    def _write(self, df, database, schema, table):
+        path = self._path(database, schema, table)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write to a temp file first so readers never see partial tables
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        df.to_parquet(tmp_path, compression="zstd", index=False)
+        os.replace(tmp_path, path)
+
+    def create(self, stage, database, schema, table):
+        self._write(self._load(stage), database, schema, table)
+
+    def replace(self, df, database, schema, table):
+        self._write(df, database, schema, table)
+
+    def merge(self, stage, database, schema, table, key_cols, cols):
+        # categories differ between uploads, compare and assign plain values
+        source = _decategorize(self._load(stage))
+        target = _decategorize(self.read(database, schema, table))
+
+        _check_columns(list(target.columns), cols, f"{database}.{schema}.{table}")
+
+        target_index = pd.MultiIndex.from_frame(target[key_cols])
+        positions = target_index.get_indexer(pd.MultiIndex.from_frame(source[key_cols]))
+        matched = positions >= 0
+
+        value_cols = [col for col in cols if col not in key_cols]
+        old = target[value_cols].iloc[positions[matched]].reset_index(drop=True)
+        new = source.loc[matched, value_cols].reset_index(drop=True)
+        # NaN == NaN counts as unchanged, like EQUAL_NULL
+        changed = ~((old == new) | (old.isna() & new.isna())).all(axis=1).to_numpy()
+
+        rows = positions[matched][changed]
+        updates = source.loc[matched].iloc[changed]
+        inserts = source.loc[~matched]
+        if len(updates) or len(inserts):
+            merged = target.copy()
+            for col in value_cols:
+                merged.loc[rows, col] = updates[col].to_numpy()
+            merged = pd.concat([merged, inserts[target.columns]], ignore_index=True)
+            self._write(merged, database, schema, table)
+
+        return {
+            "inserted": int((~matched).sum()),
+            "updated": int(changed.sum()),
+            "unchanged": int(matched.sum() - changed.sum()),
+        }
+
+
+class SnowflakeBackend:
+    """
+    Stages Parquet chunks in a Snowflake stage, bulk loads them with COPY INTO and
+    applies them with one MERGE. replace uploads with fdb.upload(if_exists="replace")
+    instead, like the model scripts did.
+
+    engine: SQLAlchemy engine on the warehouse, which upserts run on. replace
+    uploads go through fdb and work without one.
+    """
+
+    def __init__(self, engine=None):
+        self._engine = engine
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            raise ValueError("upserts need SnowflakeBackend(engine)")
+        return self._engine
+
+    def _execute(self, *statements, returning=-1):
+        """Run statements in one session, returns the rows of statements[returning]"""
+
+        from sqlalchemy import text
+
+        rows = []
+        with self.engine.begin() as conn:
+            for sql in statements:
+                result = conn.execute(text(sql))
+                rows.append(result.fetchall() if result.returns_rows else None)
+        return rows[returning]
+
+    def exists(self, database, schema, table):
+        return bool(
+            self._execute(f"SHOW TABLES LIKE '{table}' IN SCHEMA {database}.{schema}")
+        )
+
+    def stage(self, paths, database, schema):
+        # a named stage, as temporary ones are gone with the session that made them
+        stage = f"{database}.{schema}.BIZCATE_UPLOAD_{uuid.uuid4().hex.upper()}"
+        self._execute(
+            f"CREATE STAGE {stage} FILE_FORMAT = (TYPE = PARQUET)",
+            *[
+                f"PUT 'file://{Path(path).resolve().as_posix()}' @{stage} "
+                "AUTO_COMPRESS = FALSE PARALLEL = 8"
+                for path in paths
+            ],
+        )
+        return stage
+
+    def drop_stage(self, stage):
+        self._execute(f"DROP STAGE IF EXISTS {stage}")
+
+    def replace(self, df, database, schema, table):
+        from db import fdb
+
+        fdb.upload(
+            df=df, database=database, schema=schema, table=table, if_exists="replace"
+        )
+
+    @staticmethod
+    def _copy_into(stage, target):
+        return (
+            f"COPY INTO {target} FROM @{stage} "
+            "FILE_FORMAT = (TYPE = PARQUET) MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE"
+        )
+
+    def create(self, stage, database, schema, table):
+        target = f"{database}.{schema}.{table}"
+        file_format = f"{database}.{schema}.BIZCATE_UPLOAD_PARQUET"
+        self._execute(
+            f"CREATE FILE FORMAT IF NOT EXISTS {file_format} TYPE = PARQUET",
+            f"CREATE TABLE {target} USING TEMPLATE ("
+            "SELECT ARRAY_AGG(OBJECT_CONSTRUCT(*)) FROM TABLE(INFER_SCHEMA("
+            f"LOCATION => '@{stage}', FILE_FORMAT => '{file_format}')))",
+            self._copy_into(stage, target),
+        )
+
+    def merge(self, stage, database, schema, table, key_cols, cols):
+        target = f"{database}.{schema}.{table}"
+        # stage is qualified by stage() already
+        loaded = f"{stage}_LOADED"
+
+        # unquoted identifiers are upper case, COPY INTO matches case-insensitively
+        table_cols = self._execute(
+            f"SELECT COLUMN_NAME FROM {database}.INFORMATION_SCHEMA.COLUMNS "
+            f"WHERE TABLE_SCHEMA = '{schema}' AND TABLE_NAME = '{table}' "
+            "ORDER BY ORDINAL_POSITION"
+        )
+        _check_columns(
+            [col.upper() for (col,) in table_cols],
+            [col.upper() for col in cols],
+            target,
+        )
+
+        value_cols = [col for col in cols if col not in key_cols]
+        on = " AND ".join(f"t.{col} = s.{col}" for col in key_cols)
+        changed = (
+            " OR ".join(f"NOT EQUAL_NULL(t.{col}, s.{col})" for col in value_cols)
+            or "FALSE"
+        )
+        matched = f"t.{key_cols[0]} IS NOT NULL"
+
+        update = ""
+        if value_cols:
+            assignments = ", ".join(f"{col} = s.{col}" for col in value_cols)
+            update = f"WHEN MATCHED AND ({changed}) THEN UPDATE SET {assignments} "
+
+        counts = (
+            f"SELECT COUNT_IF(NOT {matched}), COUNT_IF({matched} AND ({changed})), "
+            f"COUNT_IF({matched} AND NOT ({changed})) "
+            f"FROM {loaded} s LEFT JOIN {target} t ON {on}"
+        )
+        merge = (
+            f"MERGE INTO {target} t USING {loaded} s ON {on} {update}"
+            f"WHEN NOT MATCHED THEN INSERT ({', '.join(cols)}) "
+            f"VALUES ({', '.join(f's.{col}' for col in cols)})"
+        )
+
+        # the temporary table only exists in this session, so run in one call
+        inserted, updated, unchanged = self._execute(
+            f"CREATE TEMPORARY TABLE {loaded} LIKE {target}",
+            self._copy_into(stage, loaded),
+            counts,
+            merge,
+            returning=2,
+        )[0]
+        return {"inserted": inserted, "updated": updated, "unchanged": unchanged}
+
+
+# %%
+class UploadQueue:
+    """
+    Runs upserts on background threads, at most max_workers at a time, so callers
+    can move on to the next metric while the previous one is still uploading.
+
+    submit takes a finished DataFrame or pyarrow dataset and the upsert arguments,
+    or replace=True and the replace_table ones.
+    wait blocks until every upload is done and returns one record per upload
+    with its table, status ("done" or "failed"), seconds and upsert stats or
+    error. Failures never raise from the background thread, they are reported
+    by wait.
+    """
+
+    def __init__(self, backend, max_workers=2, verbose=True):
+        self.backend = backend
+        self.max_workers = max_workers
+        self.verbose = verbose
+        self._executor = None
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def _upload(self, data, table, replace=False, **kwargs):
+        start = time.perf_counter()
+        try:
+            upload = replace_table if replace else upsert
+            stats = upload(data, table=table, backend=self.backend, **kwargs)
+            record = {"table": table, "status": "done", **stats}
+        except Exception as error:
+            record = {"table": table, "status": "failed", "error": repr(error)}
+        record["seconds"] = time.perf_counter() - start
+
+        if self.verbose:
+            print(f"upload {record['status']}: {record}")
+        return record
+
+    def submit(self, data, table, **kwargs):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="upload"
+                )
+            future = self._executor.submit(self._upload, data, table, **kwargs)
+            self._futures.append(future)
+        return future
+
+    def wait(self):
+        with self._lock:
+            futures, self._futures = self._futures, []
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        return [future.result() for future in futures]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wait()
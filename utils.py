@@ -1,4 +1,5 @@
 # %%
+import logging
 import warnings
 
 warnings.filterwarnings("ignore")
@@ -10,11 +11,10 @@ from siuba import *
 from siuba.dply.vector import *
 from siuba.siu.dispatchers import verb_dispatch
 from siuba.sql import LazyTbl
-import io
-from contextlib import redirect_stdout
 from datetime import date
 from dateutil.relativedelta import relativedelta
 
+logger = logging.getLogger(__name__)
 
 
 # %%
@@ -68,12 +68,51 @@ def reset_index(__data, drop=True):
 
 
 def get_query_string(lazy_tbl):
-    f = io.StringIO()  # create a memory file object
+    """Compiled SQL of lazy_tbl with literal binds rendered"""
 
-    with redirect_stdout(f):  # redirect stdout to f
-        tmp = lazy_tbl >> show_query(simplify=True)  # call the function that prints to stdout
+    # compiled directly rather than capturing show_query's print, which swaps the
+    # global sys.stdout and is not safe from threads
+    return lazy_tbl >> show_query(return_table=False)
 
-    return f.getvalue()  # get the captured output as a string
+
+def complete_table(df, identifying_cols, date_col, fill_values=None):
+    """
+    Expand df to every distinct identifying_cols combination x every distinct date.
+
+    fill_values maps column name -> value used for the rows added by the expansion
+    (and any pre-existing missing values in that column).
+    """
+
+    keys = identifying_cols + [date_col]
+
+    # Distinct identifying combinations and dates, both sorted
+    unique_ids = df[identifying_cols].drop_duplicates().sort_values(by=identifying_cols)
+    unique_dates = np.sort(df[date_col].unique())
+
+    # Build the cartesian index once: ids x dates
+    id_positions, date_positions = pd.MultiIndex.from_product(
+        [range(len(unique_ids)), range(len(unique_dates))]
+    ).codes
+    complete_index = pd.MultiIndex.from_arrays(
+        [unique_ids[col].to_numpy()[id_positions] for col in identifying_cols]
+        + [unique_dates[date_positions]],
+        names=keys,
+    )
+
+    if df.duplicated(subset=keys).any():
+        # reindex needs unique keys, left-merge duplicated ones like before (every
+        # duplicate row is kept)
+        expanded_df = complete_index.to_frame(index=False).merge(
+            df, how="left", on=keys
+        )
+    else:
+        # Align the original rows to the complete index in a single pass
+        expanded_df = df.set_index(keys).reindex(complete_index).reset_index()
+
+    if fill_values:
+        expanded_df = expanded_df.fillna(fill_values)
+
+    return expanded_df
 
 
 def first_day_of_previous_month():
@@ -81,6 +120,7 @@ def first_day_of_previous_month():
     last_month_start = today.replace(day=1) - relativedelta(months=1)
     return last_month_start
 
+
 def logit(x, min=0.00000001, max=0.99999999):
     """Convert to logit space"""
 
@@ -95,4 +135,71 @@ def inv_logit(x):
 
     p = np.exp(x) / (1 + np.exp(x))
     p[np.isnan(p) & ~np.isnan(x)] = 1
-    return p
\ No newline at end of file
+    return p
+
+
+# Narrowest dtypes for the id and code columns shared by the bizcate tables
+COMPACT_DTYPES = {
+    "CUT_ID": "int16",
+    "IMPUTED": "int8",
+    "OPTION": "category",
+    "RETAILER_CODE": "int32",
+    "BIZCATE_CODE": "int32",
+    "SUB_CODE": "int32",
+    "MONTH_NUM": "int32",
+    "CHANNEL": "category",
+    "METRIC": "category",
+}
+
+
+def compact(df, dtypes=COMPACT_DTYPES, float32=False, name=None):
+    """
+    Cast the columns of df named in dtypes to their compact dtype, and with float32
+    every other float64 column to float32.
+
+    Integer casts are skipped for columns with missing values or values out of
+    range, so compacting never changes a value (float32 aside). The memory saved is
+    logged at INFO level.
+    """
+
+    # deep memory usage is slow on object columns, only measure it when logged
+    log = logger.isEnabledFor(logging.INFO)
+    before = df.memory_usage(deep=True).sum() if log else 0
+
+    casts = {}
+    for col, dtype in dtypes.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        values = df[col]
+        if dtype != "category" and np.dtype(dtype).kind in "iu":
+            info = np.iinfo(dtype)
+            if (
+                values.isna().any()
+                or values.min() < info.min
+                or values.max() > info.max
+            ):
+                continue
+            if values.dtype.kind == "f" and not (values == np.floor(values)).all():
+                continue
+        casts[col] = dtype
+    if float32:
+        casts.update(
+            {
+                col: "float32"
+                for col in df.columns
+                if col not in casts and df[col].dtype == "float64"
+            }
+        )
+
+    df = df.astype(casts) if casts else df
+
+    if log:
+        after = df.memory_usage(deep=True).sum()
+        logger.info(
+            "compacted %s: %.1fMB -> %.1fMB, %.1fMB saved",
+            name or "frame",
+            before / 1e6,
+            after / 1e6,
+            (before - after) / 1e6,
+        )
+    return df